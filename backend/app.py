@@ -1,18 +1,38 @@
 import os
 import io
+import gc
 import base64
+import json
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from PIL import Image
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from PIL import Image, UnidentifiedImageError
 import numpy as np
-from typing import List, Optional
+from typing import List, Optional, Dict, Any, AsyncIterator, Callable, Iterator, Tuple
 
 # Import project modules
 from models.image_analyzer import ImageAnalyzer
-from models.caption_generator import CaptionGenerator
+from models.analysis import ImageAnalysis
+from models.caption_generator import CaptionGenerator, DEFAULT_MAX_NEW_TOKENS
+from models.registry import ModelRegistry
 from utils.hashtag_utils import generate_hashtags
+from utils.hashtag_index import HashtagIndex, default_vocabulary
+from utils.batching import MicroBatcher
+from utils.cache import ResultCache, LRUCache, SQLiteCache, TieredCache, hash_bytes
+from utils.image_io import load_image, ImageTooLargeError, MAX_IMAGE_BYTES
+from utils.load_shedding import LoadShedder, ShedDecision, LLM, FALLBACK
+from utils.jobs import (
+    PRIORITIES, Job, JobWorkerPool, MemoryJobQueue, QueueFullError, SQLiteJobQueue, check_webhook_url
+)
+from utils.metrics import (
+    REGISTRY, Gauge, MetricsMiddleware, CAPTIONS_GENERATED, maybe_profile, timed
+)
 
 # Initialize FastAPI app
 app = FastAPI(title="Instagram Caption Generator API")
@@ -24,53 +44,748 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
+)
+
+# Request latency metrics, plus a Server-Timing header with per-stage durations if enabled
+app.add_middleware(MetricsMiddleware, server_timing=os.environ.get("SERVER_TIMING", "0") == "1")
+
+# Models are loaded on first use so workers start serving immediately.
+# MODEL_LOADING controls when they load:
+#   "lazy"       - on the first request that needs them (default)
+#   "background" - on a background thread as soon as the app starts
+#   "import"     - when this module is imported, so `gunicorn --preload` forks
+#                  workers that share the weights copy-on-write
+MODEL_LOADING = os.environ.get("MODEL_LOADING", "lazy")
+# Run one dummy request through both models once they are loaded
+WARMUP = os.environ.get("WARMUP", "0") == "1"
+# "embedding" ranks hashtags by CLIP similarity, "keyword" uses the keyword categories
+HASHTAG_ENGINE = os.environ.get("HASHTAG_ENGINE", "embedding")
+
+def build_hashtag_index() -> HashtagIndex:
+    """Embed the hashtag vocabulary with CLIP's text encoder"""
+    image_analyzer = models.get("image_analyzer")
+    return HashtagIndex.build(
+        default_vocabulary(),
+        lambda texts: image_analyzer.encode_text(texts).cpu().float().numpy(),
+        model_name=image_analyzer.model_name,
+        cache_dir=image_analyzer.cache_dir
+    )
+
+model_factories = {
+    "image_analyzer": ImageAnalyzer,
+    "caption_generator": CaptionGenerator
+}
+if HASHTAG_ENGINE == "embedding":
+    model_factories["hashtag_index"] = build_hashtag_index
+models = ModelRegistry(model_factories)
+
+def warm_up():
+    """Run a dummy image through both models so the first real request is not slow"""
+    image_analyzer = models.get("image_analyzer")
+    size = image_analyzer.input_resolution
+    analysis = image_analyzer.analyze(Image.new("RGB", (size, size), (127, 127, 127)))
+    models.get("caption_generator").generate(analysis, num_captions=1)
+    if HASHTAG_ENGINE == "embedding":
+        generate_hashtags(analysis, index=models.get("hashtag_index"))
+
+async def get_hashtags(analysis: ImageAnalysis, count: int) -> List[str]:
+    """Select hashtags with the configured engine, ranking against the image embedding"""
+    if HASHTAG_ENGINE != "embedding":
+        return generate_hashtags(analysis, count=count)
+    index = await get_model("hashtag_index")
+    # A large vocabulary makes ranking a sizeable matmul, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(generate_hashtags, analysis, count=count, index=index))
+
+async def get_model(name: str):
+    """Return a model, loading it off the event loop if it is not loaded yet"""
+    if models.is_loaded(name):
+        return models.get(name)
+    return await asyncio.get_running_loop().run_in_executor(None, models.get, name)
+
+if MODEL_LOADING == "import":
+    models.load_all()
+    if WARMUP:
+        warm_up()
+    # Keep the garbage collector from touching (and so copying) the preloaded objects in forked workers
+    gc.freeze()
+
+@app.on_event("startup")
+def start_model_loading():
+    if MODEL_LOADING == "background":
+        models.load_in_background(warm_up if WARMUP else None)
+
+# Cache analysis and caption results (optionally shared between workers via SQLite)
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH") or None
+result_cache = ResultCache(
+    max_size=int(os.environ.get("RESULT_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.environ.get("RESULT_CACHE_TTL", "3600")),
+    path=RESULT_CACHE_PATH
+)
+
+async def cache_call(fn: Callable[..., Any], *args) -> Any:
+    """Run a result cache call, off the event loop when the shared SQLite tier may touch the disk"""
+    if RESULT_CACHE_PATH is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+# How /analyze echoes the uploaded image back:
+# "none", "thumbnail", "url" (served by GET /images/{image_id}) or "full"
+IMAGE_RESPONSE_MODES = ("none", "thumbnail", "url", "full")
+DEFAULT_IMAGE_MODE = os.environ.get("IMAGE_RESPONSE_MODE", "thumbnail")
+DEFAULT_THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "256"))
+# Larger requested thumbnails are clamped to this size
+MAX_THUMBNAIL_SIZE = int(os.environ.get("MAX_THUMBNAIL_SIZE", "1024"))
+
+# Original uploads kept for the "url" image mode, as (bytes, media type). With
+# RESULT_CACHE_PATH they are shared too, so GET /images/{image_id} works on any worker
+IMAGE_STORE_SIZE = int(os.environ.get("IMAGE_STORE_SIZE", "256"))
+shared_image_store = None
+if RESULT_CACHE_PATH:
+    root, ext = os.path.splitext(RESULT_CACHE_PATH)
+    shared_image_store = SQLiteCache(
+        f"{root}-images{ext or '.sqlite'}",
+        max_size=IMAGE_STORE_SIZE,
+        ttl_seconds=float(os.environ.get("RESULT_CACHE_TTL", "3600"))
+    )
+image_store = TieredCache(
+    LRUCache(
+        max_size=IMAGE_STORE_SIZE,
+        ttl_seconds=float(os.environ.get("RESULT_CACHE_TTL", "3600")),
+        max_bytes=int(os.environ.get("IMAGE_STORE_BYTES", str(256 * 1024 * 1024))),
+        sizeof=lambda stored: len(stored[0])
+    ),
+    shared_image_store,
+    dumps=lambda stored: [base64.b64encode(stored[0]).decode(), stored[1]],
+    loads=lambda stored: (base64.b64decode(stored[0]), stored[1])
+)
+
+# Decoding runs on its own threads so it overlaps with model inference
+decode_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DECODE_WORKERS", "4")),
+    thread_name_prefix="decode"
+)
+
+# Batch CLIP analysis across concurrent requests
+def analyze_image_batch(images: List[Image.Image]) -> List[ImageAnalysis]:
+    """Run one CLIP batch, recording a profiler trace for sampled batches"""
+    image_analyzer = models.get("image_analyzer")
+    with maybe_profile("analyze"):
+        return image_analyzer.analyze_batch(images)
+
+analyze_batcher = MicroBatcher(
+    analyze_image_batch,
+    max_batch_size=int(os.environ.get("ANALYZE_MAX_BATCH_SIZE", "8")),
+    max_wait_ms=float(os.environ.get("ANALYZE_MAX_WAIT_MS", "10")),
+    name="analyze"
+)
+
+# Most images a carousel post can have
+CAROUSEL_MAX_IMAGES = int(os.environ.get("CAROUSEL_MAX_IMAGES", "10"))
+
+# Most captions and hashtags one request can ask for; caption batches share
+# a generate call, so one large request would stall everything batched with it
+MAX_CAPTIONS = int(os.environ.get("MAX_CAPTIONS", "10"))
+MAX_HASHTAGS = int(os.environ.get("MAX_HASHTAGS", "30"))
+
+def check_counts(num_captions: int, num_hashtags: int):
+    """Reject caption and hashtag counts outside their limits with a 400"""
+    if not 1 <= num_captions <= MAX_CAPTIONS:
+        raise HTTPException(status_code=400, detail=f"num_captions must be between 1 and {MAX_CAPTIONS}")
+    if not 0 <= num_hashtags <= MAX_HASHTAGS:
+        raise HTTPException(status_code=400, detail=f"num_hashtags must be between 0 and {MAX_HASHTAGS}")
+
+CAPTION_MAX_BATCH_SIZE = int(os.environ.get("CAPTION_MAX_BATCH_SIZE", "4"))
+
+# Shed LLM work when a request's latency budget cannot be met:
+# shorter captions first, then template captions from generate_fallback
+load_shedder = LoadShedder(
+    max_new_tokens=DEFAULT_MAX_NEW_TOKENS,
+    min_new_tokens=int(os.environ.get("MIN_NEW_TOKENS", "12")),
+    max_batch_size=CAPTION_MAX_BATCH_SIZE,
+    max_queue_depth=int(os.environ["MAX_CAPTION_QUEUE_DEPTH"]) if os.environ.get("MAX_CAPTION_QUEUE_DEPTH") else None,
+    default_budget_ms=float(os.environ["LATENCY_BUDGET_MS"]) if os.environ.get("LATENCY_BUDGET_MS") else None
+)
+
+def generate_caption_batch(requests: List[Tuple]) -> List[List[str]]:
+    """Run one caption batch and feed its duration to the load shedder"""
+    caption_generator = models.get("caption_generator")
+    start = time.perf_counter()
+    with maybe_profile("caption"):
+        results = caption_generator.generate_batch(requests)
+    # Sequences stop early once their caption is complete, so count the steps actually run
+    steps = caption_generator.last_batch_steps
+    load_shedder.observe(steps, time.perf_counter() - start)
+    return results
+
+# Batch caption generation across concurrent requests
+caption_batcher = MicroBatcher(
+    generate_caption_batch,
+    max_batch_size=CAPTION_MAX_BATCH_SIZE,
+    max_wait_ms=float(os.environ.get("CAPTION_MAX_WAIT_MS", "20")),
+    name="caption"
+)
+
+# Token streams cannot share a batch, each runs its own generate call. A bounded
+# pool runs them, and waiting or running streams count towards the shedding queue depth
+stream_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("STREAM_WORKERS", "2")),
+    thread_name_prefix="stream"
 )
+stream_stats = {"pending": 0}
+
+def caption_queue_depth() -> int:
+    """Caption requests queued or running, batched or streamed"""
+    return caption_batcher.pending + stream_stats["pending"]
 
-# Initialize models
-image_analyzer = ImageAnalyzer()
-caption_generator = CaptionGenerator()
+REGISTRY.register(Gauge(
+    "caption_craft_batcher_pending", "Requests queued or running in each micro-batcher", ["batcher"],
+    lambda: {
+        **{(batcher.name,): batcher.pending for batcher in (analyze_batcher, caption_batcher)},
+        ("stream",): stream_stats["pending"]
+    }
+))
+
+# Job queue for POST /jobs: in process by default, or a SQLite file shared with
+# job_worker.py processes so inference scales separately from HTTP handling
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH") or None
+JOB_MAX_QUEUED_PER_CLIENT = int(os.environ.get("JOB_MAX_QUEUED_PER_CLIENT", "100"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "3600"))
+# Running jobs not renewed for this long are assumed lost with their worker and run again
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "600"))
+if JOB_QUEUE_PATH:
+    job_queue = SQLiteJobQueue(
+        JOB_QUEUE_PATH,
+        max_queued_per_client=JOB_MAX_QUEUED_PER_CLIENT,
+        ttl_seconds=JOB_TTL,
+        lease_seconds=JOB_LEASE_SECONDS
+    )
+else:
+    job_queue = MemoryJobQueue(max_queued_per_client=JOB_MAX_QUEUED_PER_CLIENT, ttl_seconds=JOB_TTL)
 
 @app.get("/")
 def read_root():
     return {"message": "Instagram Caption Generator API"}
 
+async def decode_upload(contents: bytes, target_size: int) -> Image.Image:
+    """Decode an upload on the decode thread pool, mapping bad input to HTTP errors"""
+    loop = asyncio.get_running_loop()
+    try:
+        with timed("decode"):
+            return await loop.run_in_executor(decode_executor, partial(load_image, contents, target_size))
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (UnidentifiedImageError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+
+async def get_analysis(contents: bytes, image: Optional[Image.Image] = None) -> ImageAnalysis:
+    """Return the cached analysis of an image, or decode it and run it through the batcher"""
+    image_hash = hash_bytes(contents)
+    analysis = await cache_call(result_cache.get_analysis, image_hash)
+    if analysis is None:
+        analysis = await analyze_upload(contents, image_hash, image)
+    return analysis
+
+async def analyze_upload(contents: bytes, image_hash: str, image: Optional[Image.Image] = None) -> ImageAnalysis:
+    """Analyze an image that is not in the cache, decoding it if needed, and cache the result"""
+    if image is None:
+        image_analyzer = await get_model("image_analyzer")
+        image = await decode_upload(contents, image_analyzer.input_resolution)
+    with timed("analyze"):
+        analysis = await analyze_batcher.submit(image)
+    await cache_call(result_cache.set_analysis, image_hash, analysis)
+    return analysis
+
+async def get_carousel_analysis(contents_list: List[bytes]) -> Tuple[List[ImageAnalysis], ImageAnalysis]:
+    """
+    Analyze every image of a carousel and the post as a whole
+    
+    Images missing from the cache are decoded concurrently and encoded in a
+    single batch on the analyzer's thread, rather than one by one through
+    the micro-batcher.
+    
+    Returns:
+        Per-image analyses in upload order, and the combined post analysis
+    """
+    image_analyzer = await get_model("image_analyzer")
+    hashes = [hash_bytes(contents) for contents in contents_list]
+    analyses = [await cache_call(result_cache.get_analysis, image_hash) for image_hash in hashes]
+    
+    missing = [i for i, analysis in enumerate(analyses) if analysis is None]
+    loop = asyncio.get_running_loop()
+    if missing:
+        images = await asyncio.gather(*(
+            decode_upload(contents_list[i], image_analyzer.input_resolution) for i in missing
+        ))
+        with timed("analyze"):
+            results = await loop.run_in_executor(analyze_batcher.executor, analyze_image_batch, list(images))
+        for i, analysis in zip(missing, results):
+            analyses[i] = analysis
+            await cache_call(result_cache.set_analysis, hashes[i], analysis)
+    
+    post_analysis = await loop.run_in_executor(analyze_batcher.executor, image_analyzer.combine, analyses)
+    return analyses, post_analysis
+
+async def get_captions(
+    analysis: ImageAnalysis,
+    style: str,
+    num_captions: int,
+    fresh: bool,
+    latency_budget_ms: Optional[float],
+    shed: bool = True
+) -> Tuple[List[str], List[str]]:
+    """
+    Produce captions from the cache, the LLM or the fallback templates
+    
+    Args:
+        shed: Let the load shedder truncate or replace the captions; queued
+            jobs pass False since nobody waits on them interactively
+    
+    Returns:
+        Captions and, for each one, the path that produced it ("llm", "llm_truncated" or "fallback")
+    """
+    # Regenerating with fresh=true skips the lookup but still refreshes the cache
+    captions = None if fresh else await cache_call(result_cache.get_captions, analysis, style, num_captions)
+    if captions is not None:
+        CAPTIONS_GENERATED.inc(len(captions), source="cache")
+        return captions, [LLM] * len(captions)
+    
+    caption_generator = await get_model("caption_generator")
+    token_limit = caption_generator.style_profile(style).max_new_tokens
+    if shed:
+        decision = load_shedder.decide(caption_queue_depth(), latency_budget_ms, token_limit)
+    else:
+        decision = ShedDecision(LLM, token_limit)
+    if decision.path == FALLBACK:
+        captions = caption_generator.generate_fallback(analysis, style=style, num_captions=num_captions)
+        CAPTIONS_GENERATED.inc(len(captions), source=FALLBACK)
+        return captions, [FALLBACK] * len(captions)
+    
+    # Batched with other pending requests
+    captions = await caption_batcher.submit((analysis, style, num_captions, decision.max_new_tokens))
+    if decision.path == LLM:
+        # Only full captions are cached, degraded ones should not outlive the spike
+        await cache_call(result_cache.set_captions, analysis, style, num_captions, captions)
+    CAPTIONS_GENERATED.inc(len(captions), source=decision.path)
+    return captions, [decision.path] * len(captions)
+
+async def iterate_in_thread(
+    iterator: Iterator[Any],
+    executor: Optional[ThreadPoolExecutor] = None,
+    stop: Optional[threading.Event] = None
+) -> AsyncIterator[Any]:
+    """
+    Consume a blocking iterator on a worker thread without blocking the event loop
+    
+    Closing the returned generator, e.g. when a streaming client disconnects,
+    sets `stop` and stops the worker thread after the item it is producing.
+    
+    Args:
+        iterator: Blocking iterator to consume
+        executor: Executor bounding how many iterators run at once (defaults to a new thread)
+        stop: Event set on close, which the iterator itself may watch too
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+    stop = stop or threading.Event()
+    
+    def produce():
+        try:
+            # Closed while waiting for a free executor thread
+            if stop.is_set():
+                return
+            for item in iterator:
+                if stop.is_set():
+                    # Unwind a generator so it stops its own work too
+                    if hasattr(iterator, "close"):
+                        iterator.close()
+                    return
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        loop.call_soon_threadsafe(queue.put_nowait, done)
+    
+    if executor is not None:
+        executor.submit(produce)
+    else:
+        threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def image_media_type(contents: bytes) -> str:
+    """
+    Media type of an upload, taken from its decoded format
+    
+    The client's Content-Type is never trusted: a file that decodes as an
+    image can still be HTML, and must not be served back as such.
+    """
+    try:
+        with Image.open(io.BytesIO(contents)) as image:
+            media_type = Image.MIME.get(image.format, "")
+    except Exception:
+        media_type = ""
+    return media_type if media_type.startswith("image/") else "application/octet-stream"
+
+def image_response(
+    mode: str,
+    contents: bytes,
+    image: Optional[Image.Image],
+    thumbnail_size: int
+) -> Optional[str]:
+    """
+    Build the `image` field of the /analyze response
+    
+    Returns:
+        A data URL, a URL served by GET /images/{image_id}, or None
+    """
+    if mode == "none":
+        return None
+    
+    if mode == "url":
+        # The client already has the original, just keep it around briefly for sharing
+        image_id = hash_bytes(contents)
+        image_store.set(image_id, (contents, image_media_type(contents)))
+        return f"/images/{image_id}"
+    
+    if mode == "full":
+        # The original bytes are already encoded, no need to decode and re-encode them
+        img_str = base64.b64encode(contents).decode()
+        return f"data:{image_media_type(contents)};base64,{img_str}"
+    
+    image = image.copy()
+    image.thumbnail((thumbnail_size, thumbnail_size))
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=85)
+    img_str = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:image/jpeg;base64,{img_str}"
+
+def sse_event(event: str, data: Any) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.post("/analyze")
 async def analyze_image(
     file: UploadFile = File(...),
     style: str = Form("casual"),
     num_captions: int = Form(3),
-    num_hashtags: int = Form(5)
+    num_hashtags: int = Form(5),
+    fresh: bool = Form(False),
+    image_mode: str = Form(DEFAULT_IMAGE_MODE),
+    thumbnail_size: int = Form(DEFAULT_THUMBNAIL_SIZE),
+    latency_budget_ms: Optional[float] = Form(None)
 ):
-    # Read and process the image
-    contents = await file.read()
-    image = Image.open(io.BytesIO(contents)).convert("RGB")
+    if image_mode not in IMAGE_RESPONSE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"image_mode must be one of {', '.join(IMAGE_RESPONSE_MODES)}"
+        )
+    if thumbnail_size < 1:
+        raise HTTPException(status_code=400, detail="thumbnail_size must be at least 1")
+    thumbnail_size = min(thumbnail_size, MAX_THUMBNAIL_SIZE)
+    check_counts(num_captions, num_hashtags)
     
-    # Get image description
-    image_description = image_analyzer.analyze(image)
+    # Read the image, decoding it up front only if the thumbnail needs it;
+    # otherwise it is decoded on a cache miss only
+    with timed("upload_read"):
+        contents = await file.read()
+    image = None
+    if image_mode == "thumbnail":
+        image_analyzer = await get_model("image_analyzer")
+        image = await decode_upload(contents, max(image_analyzer.input_resolution, thumbnail_size))
     
-    # Generate captions based on image analysis
-    captions = caption_generator.generate(
-        image_description=image_description,
-        style=style,
-        num_captions=num_captions
-    )
+    # Get image description (batched with other pending requests)
+    analysis = await get_analysis(contents, image)
+    
+    # Generate captions based on image analysis, within the latency budget
+    with timed("captions"):
+        captions, caption_sources = await get_captions(analysis, style, num_captions, fresh, latency_budget_ms)
     
     # Generate hashtags
-    hashtags = generate_hashtags(image_description, count=num_hashtags)
+    with timed("hashtags"):
+        hashtags = await get_hashtags(analysis, num_hashtags)
     
-    # Encode image to base64 for response
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    # Echo the image back in the requested form
+    with timed("image_echo"):
+        # Encoding a thumbnail or writing to the shared image store would block the event loop
+        image_field = await asyncio.get_running_loop().run_in_executor(
+            None, image_response, image_mode, contents, image, thumbnail_size
+        )
+    
+    return JSONResponse({
+        "image": image_field,
+        "description": analysis.to_dict(),
+        "captions": captions,
+        "caption_sources": caption_sources,
+        "hashtags": hashtags,
+        "style": style
+    })
+
+@app.post("/analyze/stream")
+async def analyze_image_stream(
+    file: UploadFile = File(...),
+    style: str = Form("casual"),
+    num_captions: int = Form(3),
+    num_hashtags: int = Form(5),
+    fresh: bool = Form(False),
+    latency_budget_ms: Optional[float] = Form(None)
+):
+    """
+    Streaming variant of /analyze using server-sent events
+    
+    Events, in order: `analysis` (image description), `hashtags`, then
+    `token` chunks tagged with their caption index, a `caption` event with
+    each cleaned caption and the path that produced it, and finally `done`
+    with all captions.
+    """
+    check_counts(num_captions, num_hashtags)
+    with timed("upload_read"):
+        contents = await file.read()
+    
+    # Decode before streaming starts so bad uploads still get a proper status code
+    image_hash = hash_bytes(contents)
+    cached_analysis = await cache_call(result_cache.get_analysis, image_hash)
+    image = None
+    if cached_analysis is None:
+        image_analyzer = await get_model("image_analyzer")
+        image = await decode_upload(contents, image_analyzer.input_resolution)
+    
+    async def events() -> AsyncIterator[str]:
+        analysis = cached_analysis or await analyze_upload(contents, image_hash, image)
+        yield sse_event("analysis", {"description": analysis.to_dict(), "style": style})
+        
+        hashtags = await get_hashtags(analysis, num_hashtags)
+        yield sse_event("hashtags", {"hashtags": hashtags})
+        
+        captions = None if fresh else await cache_call(result_cache.get_captions, analysis, style, num_captions)
+        decision = None
+        if captions is None:
+            caption_generator = await get_model("caption_generator")
+            decision = load_shedder.decide(
+                caption_queue_depth(), latency_budget_ms, caption_generator.style_profile(style).max_new_tokens
+            )
+        
+        if decision is not None and decision.path != FALLBACK:
+            captions = [""] * num_captions
+            stop = threading.Event()
+            stream = caption_generator.stream(
+                analysis, style=style, num_captions=num_captions, max_new_tokens=decision.max_new_tokens, stop=stop
+            )
+            tokens = iterate_in_thread(stream, stream_executor, stop)
+            stream_stats["pending"] += 1
+            try:
+                async for kind, index, text in tokens:
+                    if kind == "token":
+                        yield sse_event("token", {"index": index, "text": text})
+                    else:
+                        captions[index] = text
+                        yield sse_event("caption", {"index": index, "caption": text, "source": decision.path})
+            finally:
+                stream_stats["pending"] -= 1
+                # Sets stop, which ends generate within one decoding step when the client disconnects
+                await tokens.aclose()
+            if decision.path == LLM:
+                await cache_call(result_cache.set_captions, analysis, style, num_captions, captions)
+            CAPTIONS_GENERATED.inc(len(captions), source=decision.path)
+        else:
+            if decision is not None:
+                # Over budget: template captions, nothing to stream token by token
+                captions = caption_generator.generate_fallback(analysis, style=style, num_captions=num_captions)
+            source = decision.path if decision is not None else LLM
+            CAPTIONS_GENERATED.inc(len(captions), source=source if decision is not None else "cache")
+            for index, caption in enumerate(captions):
+                yield sse_event("caption", {"index": index, "caption": caption, "source": source})
+        
+        caption_sources = [decision.path if decision is not None else LLM] * len(captions)
+        yield sse_event("done", {"captions": captions, "caption_sources": caption_sources})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/analyze/carousel")
+async def analyze_carousel(
+    files: List[UploadFile] = File(...),
+    style: str = Form("casual"),
+    num_captions: int = Form(3),
+    num_hashtags: int = Form(5),
+    fresh: bool = Form(False),
+    latency_budget_ms: Optional[float] = Form(None)
+):
+    """
+    Analyze a multi-image post and caption it as a whole
+    
+    The images are encoded in one batch and their embeddings are combined
+    into a post-level analysis, which gets a single set of captions and
+    hashtags.
+    """
+    if len(files) > CAROUSEL_MAX_IMAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A carousel can have at most {CAROUSEL_MAX_IMAGES} images"
+        )
+    check_counts(num_captions, num_hashtags)
+    
+    with timed("upload_read"):
+        contents_list = [await file.read() for file in files]
+    
+    analyses, post_analysis = await get_carousel_analysis(contents_list)
+    
+    with timed("captions"):
+        captions, caption_sources = await get_captions(post_analysis, style, num_captions, fresh, latency_budget_ms)
+    
+    with timed("hashtags"):
+        hashtags = await get_hashtags(post_analysis, num_hashtags)
     
     return JSONResponse({
-        "image": f"data:image/jpeg;base64,{img_str}",
-        "description": image_description,
+        "images": [
+            {"filename": file.filename, "description": analysis.to_dict()}
+            for file, analysis in zip(files, analyses)
+        ],
+        "description": post_analysis.to_dict(),
         "captions": captions,
+        "caption_sources": caption_sources,
         "hashtags": hashtags,
         "style": style
     })
 
+async def run_job(job: Job) -> Dict[str, Any]:
+    """Run a queued job through the /analyze pipeline"""
+    params = job.params
+    try:
+        analysis = await get_analysis(job.payload)
+    except HTTPException as e:
+        raise ValueError(e.detail)
+    captions, caption_sources = await get_captions(
+        analysis, params["style"], params["num_captions"], params["fresh"], None, shed=False
+    )
+    hashtags = await get_hashtags(analysis, params["num_hashtags"])
+    return {
+        "description": analysis.to_dict(),
+        "captions": captions,
+        "caption_sources": caption_sources,
+        "hashtags": hashtags,
+        "style": params["style"]
+    }
+
+# Inference workers draining the job queue (0 makes this process only accept jobs)
+job_workers = JobWorkerPool(
+    job_queue,
+    run_job,
+    num_workers=int(os.environ.get("JOB_WORKERS", "2")),
+    max_running_per_client=int(os.environ.get("JOB_CLIENT_CONCURRENCY", "2"))
+)
+
+@app.on_event("startup")
+def start_job_workers():
+    if job_workers.num_workers:
+        job_workers.start()
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    request: Request,
+    file: UploadFile = File(...),
+    style: str = Form("casual"),
+    num_captions: int = Form(3),
+    num_hashtags: int = Form(5),
+    fresh: bool = Form(False),
+    priority: str = Form("normal"),
+    webhook_url: Optional[str] = Form(None),
+    client_id: Optional[str] = Form(None)
+):
+    """
+    Queue an /analyze request and return its id right away
+    
+    Poll GET /jobs/{job_id} for the result, or pass webhook_url to have the
+    finished job POSTed to it. Jobs run highest priority first, with at most
+    JOB_CLIENT_CONCURRENCY jobs of one client address running at a time;
+    client_id only labels the job.
+    """
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITIES)}")
+    check_counts(num_captions, num_hashtags)
+    if webhook_url:
+        try:
+            # Resolving the host blocks, keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, check_webhook_url, webhook_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    # Caps are keyed on the connection, a client could dodge them by changing its client_id
+    client_address = request.client.host if request.client else "anonymous"
+    client_label = client_id or request.headers.get("x-client-id")
+    
+    # Checked now rather than at decode time, the payload waits in the queue until then
+    contents = await file.read()
+    if len(contents) > MAX_IMAGE_BYTES:
+        raise HTTPException(
+            status_code=413, detail=f"Image is {len(contents)} bytes, the limit is {MAX_IMAGE_BYTES}"
+        )
+    
+    params = {"style": style, "num_captions": num_captions, "num_hashtags": num_hashtags, "fresh": fresh}
+    try:
+        # A SQLite queue may wait for another process's lock, keep that off the event loop
+        job = await asyncio.get_running_loop().run_in_executor(
+            None, job_queue.submit, contents, params, priority, client_address, webhook_url, client_label
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    job_workers.notify()
+    
+    return JSONResponse(
+        {"id": job.id, "status": job.status, "url": f"/jobs/{job.id}"},
+        status_code=202,
+        headers={"Location": f"/jobs/{job.id}"}
+    )
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Return the state of a job, with its result once done"""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job.to_dict()
+
+@app.get("/ready")
+def readiness():
+    """
+    Readiness probe: 200 once every model is loaded, 503 before that
+    
+    With lazy loading nothing else would load the models before traffic
+    arrives, so the first probe starts loading them in the background.
+    """
+    ready = models.is_ready()
+    if not ready and MODEL_LOADING == "lazy":
+        models.load_in_background(warm_up if WARMUP else None)
+    return JSONResponse(
+        {"ready": ready, "models": models.status()},
+        status_code=200 if ready else 503
+    )
+
+@app.get("/images/{image_id}")
+def get_image(image_id: str):
+    """Serve an upload stored by /analyze with image_mode=url"""
+    stored = image_store.get(image_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Image not found or expired")
+    contents, media_type = stored
+    return Response(
+        content=contents,
+        media_type=media_type,
+        headers={"Cache-Control": "private, max-age=3600", "X-Content-Type-Options": "nosniff"}
+    )
+
 @app.get("/styles")
 def get_available_styles():
     """Return available caption styles"""
@@ -85,5 +800,20 @@ def get_available_styles():
         ]
     }
 
+@app.get("/stats")
+def get_stats():
+    """Return inference batching statistics"""
+    return {
+        "batchers": [analyze_batcher.stats(), caption_batcher.stats()],
+        "cache": result_cache.stats(),
+        "load_shedding": load_shedder.stats(),
+        "jobs": job_workers.stats()
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    """Expose metrics in the Prometheus text format"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,445 @@
+"""
+Offline bulk captioning for directories and manifests of images
+
+Images are decoded and preprocessed in a process pool, then flow through
+batched CLIP and caption stages connected by bounded queues, so memory stays
+flat no matter how large the dataset is. Results are appended to the output
+as they complete; rerunning the same command resumes where it stopped.
+
+Usage:
+    python batch_caption.py --input photos/ --output captions.jsonl
+    python batch_caption.py --input manifest.jsonl --output captions/ --format parquet
+"""
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import numpy as np
+import torch
+
+from models.image_analyzer import ImageAnalyzer
+from models.caption_generator import CaptionGenerator
+from utils.hashtag_utils import generate_hashtags
+from utils.image_io import load_image
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff"}
+
+# Marks the end of a stage's input
+_END = object()
+
+
+class StageStats:
+    """Count items and busy time of one pipeline stage"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def rate(self) -> float:
+        """Images per second while the stage was busy"""
+        return self.items / self.busy_seconds if self.busy_seconds else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "stage": self.name,
+            "images": self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "images_per_sec": round(self.rate(), 2),
+        }
+
+
+def iter_inputs(path: str, defaults: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    List the images to caption
+
+    Args:
+        path: Directory (searched recursively) or JSONL manifest with a `path`
+              per line and optional `id`, `style`, `num_captions`, `num_hashtags`
+        defaults: Values used for fields the manifest does not set
+
+    Yields:
+        Records with at least `id` and `path`
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    full_path = os.path.join(root, name)
+                    yield dict(defaults, id=os.path.relpath(full_path, path), path=full_path)
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = dict(defaults, **json.loads(line))
+            if not os.path.isabs(record["path"]):
+                record["path"] = os.path.join(base_dir, record["path"])
+            record.setdefault("id", record["path"])
+            yield record
+
+
+_worker_preprocess = None
+
+
+def _init_worker(preprocess):
+    """Store the CLIP preprocessing transform in each pool process"""
+    global _worker_preprocess
+    _worker_preprocess = preprocess
+    # One pool process per core already, avoid oversubscribing threads
+    torch.set_num_threads(1)
+
+
+def _decode(path: str, target_size: int) -> np.ndarray:
+    """Decode, downscale and preprocess one image inside a pool process"""
+    return _worker_preprocess(load_image(path, target_size)).numpy()
+
+
+class JSONLWriter:
+    """Append result rows to a JSONL file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def completed_ids(path: str) -> Set[str]:
+        """Ids already captioned successfully by a previous run"""
+        done = set()
+        if not os.path.exists(path):
+            return done
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partial last line from an interrupted run
+                    continue
+                if "error" not in row:
+                    done.add(row["id"])
+        return done
+
+    def write(self, row: Dict[str, Any]):
+        self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class ParquetWriter:
+    """Write result rows as a directory of Parquet part files"""
+
+    COLUMNS = ["id", "path", "style", "description", "captions", "hashtags", "error"]
+
+    def __init__(self, path: str, rows_per_file: int = 1000):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow: pip install pyarrow")
+        self.path = path
+        self.rows_per_file = rows_per_file
+        os.makedirs(path, exist_ok=True)
+        self._rows = []
+        self._part = len([f for f in os.listdir(path) if f.endswith(".parquet")])
+
+    @staticmethod
+    def completed_ids(path: str) -> Set[str]:
+        """Ids already captioned successfully by a previous run"""
+        done = set()
+        if not os.path.isdir(path):
+            return done
+        import pyarrow.parquet as pq
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".parquet"):
+                table = pq.read_table(os.path.join(path, name), columns=["id", "error"])
+                for row_id, error in zip(table["id"].to_pylist(), table["error"].to_pylist()):
+                    if error is None:
+                        done.add(row_id)
+        return done
+
+    def write(self, row: Dict[str, Any]):
+        # Fixed columns so error rows and result rows share one schema
+        self._rows.append({column: row.get(column) for column in self.COLUMNS})
+        if len(self._rows) >= self.rows_per_file:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(self._rows)
+        # Write under a temporary name so a crash never leaves a truncated part
+        final_path = os.path.join(self.path, f"part-{self._part:05d}.parquet")
+        pq.write_table(table, final_path + ".tmp")
+        os.replace(final_path + ".tmp", final_path)
+        self._part += 1
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+
+class CaptionPipeline:
+    """Streaming decode -> CLIP -> caption pipeline with bounded queues"""
+
+    def __init__(
+        self,
+        image_analyzer: ImageAnalyzer,
+        caption_generator: CaptionGenerator,
+        decode_workers: int = 4,
+        clip_batch_size: int = 32,
+        llm_batch_size: int = 8,
+        queue_size: int = 64,
+        target_size: int = 224
+    ):
+        """
+        Args:
+            image_analyzer: Loaded ImageAnalyzer
+            caption_generator: Loaded CaptionGenerator
+            decode_workers: Number of decode/preprocess processes
+            clip_batch_size: Images per encode_image call
+            llm_batch_size: Images per caption generation call
+            queue_size: Capacity of each inter-stage queue (bounds memory)
+            target_size: Size images are downscaled to before preprocessing
+        """
+        self.image_analyzer = image_analyzer
+        self.caption_generator = caption_generator
+        self.decode_workers = decode_workers
+        self.clip_batch_size = clip_batch_size
+        self.llm_batch_size = llm_batch_size
+        self.queue_size = queue_size
+        self.target_size = target_size
+
+        self.stats = {name: StageStats(name) for name in ["decode", "clip", "caption", "write"]}
+
+    def run(self, records: Iterator[Dict[str, Any]], writer, progress_every: float = 10.0) -> int:
+        """
+        Caption every record, writing results as they complete
+
+        Returns:
+            Number of rows written
+        """
+        decoded = queue.Queue(self.queue_size)
+        analyzed = queue.Queue(self.queue_size)
+        finished = queue.Queue(self.queue_size)
+        errors = []
+
+        def guarded(target, *args):
+            def run():
+                try:
+                    target(*args)
+                except BaseException as e:
+                    errors.append(e)
+                    # Unblock the writer so the failure surfaces instead of hanging
+                    finished.put(_END)
+            return threading.Thread(target=run, daemon=True)
+
+        threads = [
+            guarded(self._decode_stage, records, decoded, finished),
+            guarded(self._clip_stage, decoded, analyzed, finished),
+            guarded(self._caption_stage, analyzed, finished),
+        ]
+        for thread in threads:
+            thread.start()
+
+        written = 0
+        started = time.monotonic()
+        last_report = started
+        while True:
+            row = finished.get()
+            if row is _END:
+                break
+            start = time.perf_counter()
+            writer.write(row)
+            written += 1
+            self.stats["write"].record(1, time.perf_counter() - start)
+
+            now = time.monotonic()
+            if now - last_report >= progress_every:
+                writer.flush()
+                self._report(written, now - started)
+                last_report = now
+
+        writer.flush()
+        if errors:
+            raise errors[0]
+        for thread in threads:
+            thread.join()
+        self._report(written, time.monotonic() - started)
+        return written
+
+    def _decode_stage(self, records, decoded: queue.Queue, finished: queue.Queue):
+        """Decode images in a process pool, keeping a bounded number in flight"""
+        pending = []
+        with ProcessPoolExecutor(
+            max_workers=self.decode_workers,
+            initializer=_init_worker,
+            initargs=(self.image_analyzer.preprocess,)
+        ) as pool:
+            for record in records:
+                pending.append((record, time.perf_counter(), pool.submit(_decode, record["path"], self.target_size)))
+                if len(pending) >= self.queue_size:
+                    self._collect_decoded(pending.pop(0), decoded, finished)
+            for item in pending:
+                self._collect_decoded(item, decoded, finished)
+        decoded.put(_END)
+
+    def _collect_decoded(self, item, decoded: queue.Queue, finished: queue.Queue):
+        record, submitted, future = item
+        try:
+            pixels = future.result()
+        except Exception as e:
+            finished.put({"id": record["id"], "path": record["path"], "error": f"decode failed: {e}"})
+            return
+        # Wall time per image divided by pool width approximates the pool's busy time
+        self.stats["decode"].record(1, (time.perf_counter() - submitted) / self.decode_workers)
+        decoded.put((record, pixels))
+
+    def _clip_stage(self, decoded: queue.Queue, analyzed: queue.Queue, finished: queue.Queue):
+        """Run batched CLIP analysis"""
+        for batch in self._batches(decoded, self.clip_batch_size):
+            start = time.perf_counter()
+            image_input = torch.from_numpy(np.stack([pixels for _, pixels in batch]))
+            try:
+                analyses = self.image_analyzer.analyze_preprocessed(image_input)
+            except Exception as e:
+                for record, _ in batch:
+                    finished.put({"id": record["id"], "path": record["path"], "error": f"analysis failed: {e}"})
+                continue
+            self.stats["clip"].record(len(batch), time.perf_counter() - start)
+            for (record, _), analysis in zip(batch, analyses):
+                analyzed.put((record, analysis))
+        analyzed.put(_END)
+
+    def _caption_stage(self, analyzed: queue.Queue, finished: queue.Queue):
+        """Run batched caption generation and hashtag selection"""
+        for batch in self._batches(analyzed, self.llm_batch_size):
+            start = time.perf_counter()
+            requests = [
+                (analysis, record.get("style", "casual"), int(record.get("num_captions", 3)))
+                for record, analysis in batch
+            ]
+            try:
+                all_captions = self.caption_generator.generate_batch(requests)
+            except Exception as e:
+                for record, _ in batch:
+                    finished.put({"id": record["id"], "path": record["path"], "error": f"captioning failed: {e}"})
+                continue
+
+            for (record, analysis), captions in zip(batch, all_captions):
+                finished.put({
+                    "id": record["id"],
+                    "path": record["path"],
+                    "style": record.get("style", "casual"),
+                    "description": analysis.description,
+                    "captions": captions,
+                    "hashtags": generate_hashtags(analysis, count=int(record.get("num_hashtags", 5))),
+                })
+            self.stats["caption"].record(len(batch), time.perf_counter() - start)
+        finished.put(_END)
+
+    @staticmethod
+    def _batches(source: queue.Queue, size: int, max_wait: float = 0.05) -> Iterator[List[Any]]:
+        """Group queue items into batches, emitting a partial batch once upstream stalls"""
+        batch = []
+        while True:
+            item = source.get() if not batch else _get_with_timeout(source, max_wait)
+            if item is None:
+                # Nothing else arrived in time, process what we have rather than stall
+                yield batch
+                batch = []
+                continue
+            if item is _END:
+                if batch:
+                    yield batch
+                return
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+
+    def _report(self, written: int, elapsed: float):
+        """Print throughput per stage to stderr"""
+        stages = ", ".join(
+            f"{s.name} {s.rate():.1f} img/s" for s in self.stats.values() if s.items
+        )
+        overall = written / elapsed if elapsed else 0.0
+        print(f"[{written} written, {overall:.1f} img/s overall] {stages}", file=sys.stderr, flush=True)
+
+
+def _get_with_timeout(source: queue.Queue, timeout: float) -> Optional[Any]:
+    try:
+        return source.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Caption a directory or JSONL manifest of images")
+    parser.add_argument("--input", required=True, help="Image directory or JSONL manifest")
+    parser.add_argument("--output", required=True, help="Output JSONL file, or directory for parquet")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--style", default="casual")
+    parser.add_argument("--num-captions", type=int, default=3)
+    parser.add_argument("--num-hashtags", type=int, default=5)
+    parser.add_argument("--decode-workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--clip-batch-size", type=int, default=32)
+    parser.add_argument("--llm-batch-size", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, default=64, help="Capacity of each inter-stage queue")
+    parser.add_argument("--parquet-rows", type=int, default=1000, help="Rows per parquet part file")
+    parser.add_argument("--no-resume", action="store_true", help="Caption everything, even ids already in the output")
+    args = parser.parse_args(argv)
+
+    writer_cls = ParquetWriter if args.format == "parquet" else JSONLWriter
+    done = set() if args.no_resume else writer_cls.completed_ids(args.output)
+    if done:
+        print(f"Resuming: skipping {len(done)} images already captioned", file=sys.stderr)
+
+    defaults = {"style": args.style, "num_captions": args.num_captions, "num_hashtags": args.num_hashtags}
+    records = (r for r in iter_inputs(args.input, defaults) if r["id"] not in done)
+
+    image_analyzer = ImageAnalyzer()
+    pipeline = CaptionPipeline(
+        image_analyzer,
+        CaptionGenerator(),
+        decode_workers=args.decode_workers,
+        clip_batch_size=args.clip_batch_size,
+        llm_batch_size=args.llm_batch_size,
+        queue_size=args.queue_size,
+        target_size=image_analyzer.input_resolution
+    )
+    writer = ParquetWriter(args.output, args.parquet_rows) if args.format == "parquet" else JSONLWriter(args.output)
+    try:
+        pipeline.run(records, writer)
+    finally:
+        writer.close()
+
+    print(json.dumps([s.summary() for s in pipeline.stats.values()], indent=2), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
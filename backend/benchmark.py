@@ -0,0 +1,389 @@
+"""
+Reproducible benchmarks for the analyzer, generator, hashtags and the HTTP API
+
+Component micro-benchmarks time image decoding at several resolutions,
+ImageAnalyzer, CaptionGenerator and hashtag selection. The HTTP benchmark
+drives POST /analyze through an in-process ASGI client (or a running server
+with --url) at several concurrency levels and reports throughput and
+p50/p95/p99 latency.
+
+With --tiny (the default) the models are small, randomly initialized CLIP
+and OPT stand-ins built from a fixed seed, so the suite runs offline and
+measures the pipeline rather than the weights. Pass --real to benchmark the
+configured models. Results are written as JSON, and --compare prints the
+change against a previous run.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --real --skip-http --output bench-real.json --compare bench-main.json
+"""
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from models.image_analyzer import ImageAnalyzer
+from models.caption_generator import CaptionGenerator
+from utils.hashtag_utils import HASHTAG_CATEGORIES, TRENDING_HASHTAGS, generate_hashtags
+from utils.hashtag_index import HashtagIndex, default_vocabulary
+from utils.image_io import load_image
+
+TINY_CLIP_NAME = "tiny-random-clip"
+TINY_LM_NAME = "tiny-random-opt"
+
+# CLIP's input normalization
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def seed_everything(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def tiny_clip(seed: int = 0, resolution: int = 224) -> Tuple[torch.nn.Module, Callable]:
+    """Build a small randomly initialized CLIP model and its preprocess transform"""
+    from clip.model import CLIP
+    from torchvision.transforms import CenterCrop, Compose, InterpolationMode, Normalize, Resize, ToTensor
+
+    torch.manual_seed(seed)
+    model = CLIP(
+        embed_dim=64,
+        image_resolution=resolution,
+        vision_layers=2,
+        vision_width=64,
+        vision_patch_size=32,
+        context_length=77,
+        vocab_size=49408,  # Must match clip.tokenize
+        transformer_width=64,
+        transformer_heads=1,
+        transformer_layers=2
+    )
+    preprocess = Compose([
+        Resize(resolution, interpolation=InterpolationMode.BICUBIC),
+        CenterCrop(resolution),
+        lambda image: image.convert("RGB"),
+        ToTensor(),
+        Normalize(CLIP_MEAN, CLIP_STD),
+    ])
+    return model.eval(), preprocess
+
+
+def tiny_causal_lm(seed: int = 0) -> Tuple[Any, Any]:
+    """
+    Build a small randomly initialized OPT model with a tokenizer trained on the fly
+
+    The byte-level BPE tokenizer is trained on the prompt templates and
+    category vocabulary, so nothing has to be downloaded.
+    """
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import OPTConfig, OPTForCausalLM, PreTrainedTokenizerFast
+
+    corpus = [
+        "Write a casual and friendly Instagram caption for a photo of a dog at the beach",
+        "Create a professional and polished Instagram caption. Keep it under 5 words:",
+        "Generate a humorous and witty, inspirational and motivational, poetic and artistic caption",
+        "An image showing people eating in a restaurant with a happy and peaceful mood.",
+    ] + [" ".join(words) for words in HASHTAG_CATEGORIES.values()] + [" ".join(TRENDING_HASHTAGS)]
+
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(corpus, vocab_size=1000, min_frequency=1, special_tokens=["<pad>", "</s>"])
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe, pad_token="<pad>", bos_token="</s>", eos_token="</s>"
+    )
+
+    torch.manual_seed(seed)
+    config = OPTConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        num_hidden_layers=2,
+        ffn_dim=256,
+        num_attention_heads=2,
+        max_position_embeddings=512,
+        word_embed_proj_dim=64,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id
+    )
+    return OPTForCausalLM(config).eval(), tokenizer
+
+
+def build_models(real: bool, seed: int, backend: Optional[str] = None) -> Tuple[ImageAnalyzer, CaptionGenerator]:
+    """Build the analyzer and generator, tiny stand-ins unless real is set"""
+    if real:
+        return ImageAnalyzer(backend=backend), CaptionGenerator(backend=backend)
+    clip_model, preprocess = tiny_clip(seed)
+    lm, tokenizer = tiny_causal_lm(seed)
+    return (
+        ImageAnalyzer(TINY_CLIP_NAME, backend=backend, model=clip_model, preprocess=preprocess),
+        # Injected language models run eagerly whatever the backend
+        CaptionGenerator(TINY_LM_NAME, backend=backend, model=lm, tokenizer=tokenizer)
+    )
+
+
+def synthetic_image(size: int, rng: np.random.Generator) -> Image.Image:
+    """Smooth random image; upsampled low resolution noise compresses like a photo"""
+    return Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).resize((size, size), Image.BICUBIC)
+
+
+def encode_jpeg(image: Image.Image, quality: int = 90) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def summarize(samples: List[float], items_per_run: int = 1) -> Dict[str, float]:
+    """Latency percentiles in milliseconds and throughput of a list of durations in seconds"""
+    samples_ms = np.asarray(samples) * 1000.0
+    return {
+        "runs": len(samples),
+        "mean_ms": round(float(samples_ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(samples_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples_ms, 99)), 3),
+        "min_ms": round(float(samples_ms.min()), 3),
+        "items_per_sec": round(items_per_run * len(samples) / max(sum(samples), 1e-9), 2),
+    }
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> List[float]:
+    """Run fn warmup + repeat times and return the durations of the timed runs"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_components(
+    image_analyzer: ImageAnalyzer,
+    caption_generator: CaptionGenerator,
+    resolutions: List[int],
+    batch_sizes: List[int],
+    repeat: int,
+    seed: int
+) -> List[Dict[str, Any]]:
+    """Time every pipeline component in isolation"""
+    rng = np.random.default_rng(seed)
+    results = []
+
+    def record(name: str, fn: Callable[[], Any], items: int = 1, **params):
+        seed_everything(seed)
+        results.append({"name": name, "params": params, **summarize(measure(fn, repeat), items)})
+        print(f"{name} {params}: p50 {results[-1]['p50_ms']} ms", file=sys.stderr)
+
+    images = {}
+    for size in resolutions:
+        payload = encode_jpeg(synthetic_image(size, rng))
+        target = image_analyzer.input_resolution
+        record("decode", lambda: load_image(payload, target), resolution=size, bytes=len(payload))
+        images[size] = load_image(payload, target)
+
+    image = images[resolutions[0]]
+    record("analyze", lambda: image_analyzer.analyze(image))
+    for batch_size in batch_sizes:
+        batch = [images[resolutions[i % len(resolutions)]] for i in range(batch_size)]
+        record("analyze_batch", lambda: image_analyzer.analyze_batch(batch), items=batch_size, batch_size=batch_size)
+
+    analysis = image_analyzer.analyze(image)
+    record("generate", lambda: caption_generator.generate(analysis, "casual", 3), items=3, num_captions=3)
+    for batch_size in batch_sizes:
+        requests = [(analysis, "casual", 3)] * batch_size
+        record(
+            "generate_batch", lambda: caption_generator.generate_batch(requests),
+            items=3 * batch_size, batch_size=batch_size, num_captions=3
+        )
+    record("generate_fallback", lambda: caption_generator.generate_fallback(analysis, "casual", 3), items=3)
+
+    record("hashtags_keyword", lambda: generate_hashtags(analysis.description, count=10))
+    index = HashtagIndex.build(
+        default_vocabulary(),
+        lambda texts: image_analyzer.encode_text(texts).cpu().float().numpy(),
+        model_name=image_analyzer.model_name
+    )
+    record("hashtags_embedding", lambda: generate_hashtags(analysis, count=10, index=index), vocabulary=len(index))
+    return results
+
+
+async def _run_load(
+    client,
+    payloads: List[bytes],
+    concurrency: int,
+    form: Dict[str, str]
+) -> Tuple[List[float], int, float]:
+    """Send every payload with at most `concurrency` requests in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(payload: bytes):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(
+                "/analyze", files={"file": ("image.jpg", payload, "image/jpeg")}, data=form
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(payload) for payload in payloads))
+    return latencies, errors, time.perf_counter() - start
+
+
+def bench_http(
+    image_analyzer: Optional[ImageAnalyzer],
+    caption_generator: Optional[CaptionGenerator],
+    url: Optional[str],
+    concurrency_levels: List[int],
+    requests_per_level: int,
+    resolution: int,
+    seed: int
+) -> List[Dict[str, Any]]:
+    """
+    Load test POST /analyze at several concurrency levels
+
+    Every request uploads a distinct image and sets fresh, so results come
+    from the models, not the analysis or caption cache.
+    """
+    import httpx
+
+    if url:
+        make_client = lambda: httpx.AsyncClient(base_url=url, timeout=300)
+    else:
+        import app as app_module
+        # Serve the benchmark's models instead of loading the configured ones
+        app_module.models.factories["image_analyzer"] = lambda: image_analyzer
+        app_module.models.factories["caption_generator"] = lambda: caption_generator
+        transport = httpx.ASGITransport(app=app_module.app)
+        make_client = lambda: httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=300)
+
+    rng = np.random.default_rng(seed)
+    # Tiny models describe every image alike, fresh keeps the caption cache out of the numbers
+    form = {"style": "casual", "num_captions": "3", "num_hashtags": "5", "image_mode": "none", "fresh": "true"}
+
+    async def run() -> List[Dict[str, Any]]:
+        results = []
+        async with make_client() as client:
+            # Warm-up request loads the models outside the measurements
+            await _run_load(client, [encode_jpeg(synthetic_image(resolution, rng))], 1, form)
+            for concurrency in concurrency_levels:
+                seed_everything(seed)
+                payloads = [encode_jpeg(synthetic_image(resolution, rng)) for _ in range(requests_per_level)]
+                latencies, errors, wall_seconds = await _run_load(client, payloads, concurrency, form)
+                result = summarize(latencies)
+                # Throughput over wall time, requests overlap
+                result["items_per_sec"] = round(len(latencies) / wall_seconds, 2)
+                result.update({"name": "http_analyze", "params": {"concurrency": concurrency, "resolution": resolution}, "errors": errors})
+                results.append(result)
+                print(f"http_analyze concurrency={concurrency}: {result['items_per_sec']} req/s, p95 {result['p95_ms']} ms", file=sys.stderr)
+        return results
+
+    return asyncio.run(run())
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result: Dict[str, Any]) -> str:
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """Describe the p50 change of every benchmark present in both runs"""
+    previous = {result_key(r): r for r in baseline["results"]}
+    lines = []
+    for result in current["results"]:
+        old = previous.get(result_key(result))
+        if old is None or not old["p50_ms"]:
+            continue
+        change = (result["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100.0
+        lines.append(f"{result['name']} {result['params']}: p50 {old['p50_ms']} -> {result['p50_ms']} ms ({change:+.1f}%)")
+    return lines
+
+
+def parse_ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the caption pipeline")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    models_group = parser.add_mutually_exclusive_group()
+    models_group.add_argument("--tiny", dest="real", action="store_false", help="Use tiny random models (default)")
+    models_group.add_argument("--real", dest="real", action="store_true", help="Use the configured models")
+    parser.set_defaults(real=False)
+    parser.add_argument("--backend", help="Inference backend, defaults to INFERENCE_BACKEND")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per micro-benchmark")
+    parser.add_argument("--resolutions", type=parse_ints, default=[256, 1024, 4096], help="Synthetic image sizes")
+    parser.add_argument("--batch-sizes", type=parse_ints, default=[1, 8])
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 4, 16], help="HTTP concurrency levels")
+    parser.add_argument("--requests", type=int, default=64, help="HTTP requests per concurrency level")
+    parser.add_argument("--url", help="Benchmark a running server instead of the in-process app")
+    parser.add_argument("--skip-components", action="store_true")
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    args = parser.parse_args(argv)
+
+    seed_everything(args.seed)
+    image_analyzer = caption_generator = None
+    if not args.skip_components or not (args.skip_http or args.url):
+        image_analyzer, caption_generator = build_models(args.real, args.seed, args.backend)
+
+    results = []
+    if not args.skip_components:
+        results += bench_components(
+            image_analyzer, caption_generator, args.resolutions, args.batch_sizes, args.repeat, args.seed
+        )
+    if not args.skip_http:
+        results += bench_http(
+            image_analyzer, caption_generator, args.url, args.concurrency, args.requests,
+            args.resolutions[min(1, len(args.resolutions) - 1)], args.seed
+        )
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "models": "real" if args.real else "tiny",
+            "backend": image_analyzer.backend if image_analyzer else None,
+            "device": image_analyzer.device if image_analyzer else None,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            for line in compare(json.load(f), report):
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Accuracy parity check between the eager torch path and another inference backend
+
+Compares top-k category agreement of ImageAnalyzer and the perplexity of
+captions under CaptionGenerator's language model, and exits non-zero if the
+candidate backend drifts beyond the given thresholds.
+
+Usage:
+    python check_parity.py --backend int8 --images path/to/sample_images
+"""
+import os
+import sys
+import json
+import argparse
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from models.image_analyzer import ImageAnalyzer
+from models.analysis import ImageAnalysis, GROUPS
+from models.caption_generator import CaptionGenerator
+from models.backends import BACKENDS, causal_lm_perplexity
+from utils.image_io import load_image
+
+
+def load_images(path: Optional[str], num_synthetic: int, seed: int = 0) -> List[Image.Image]:
+    """Load sample images from a directory, or make smooth random ones"""
+    if path:
+        images = []
+        for name in sorted(os.listdir(path)):
+            full_path = os.path.join(path, name)
+            if os.path.isfile(full_path):
+                try:
+                    images.append(load_image(full_path))
+                except Exception:
+                    continue
+        return images
+
+    # Upsampled low resolution noise looks more like a photo than per-pixel noise
+    rng = np.random.default_rng(seed)
+    return [
+        Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).resize((224, 224), Image.BICUBIC)
+        for _ in range(num_synthetic)
+    ]
+
+
+def category_agreement(reference: List[ImageAnalysis], candidate: List[ImageAnalysis]) -> Dict[str, float]:
+    """Mean overlap of the top-k categories of every group, plus top-1 agreement"""
+    result = {}
+    for group in GROUPS:
+        overlaps, top1 = [], []
+        for ref, cand in zip(reference, candidate):
+            ref_cats = list(ref.labels[group])
+            cand_cats = list(cand.labels[group])
+            overlaps.append(len(set(ref_cats) & set(cand_cats)) / max(1, len(ref_cats)))
+            top1.append(float(ref_cats[:1] == cand_cats[:1]))
+        result[f"{group}_topk"] = float(np.mean(overlaps)) if overlaps else 1.0
+        result[f"{group}_top1"] = float(np.mean(top1)) if top1 else 1.0
+    result["mean_topk"] = float(np.mean([result[f"{g}_topk"] for g in GROUPS]))
+    return result
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Check a backend against the eager torch path")
+    parser.add_argument("--backend", choices=[b for b in BACKENDS if b != "torch"], required=True)
+    parser.add_argument("--images", help="Directory of sample images (synthetic images if omitted)")
+    parser.add_argument("--num-synthetic", type=int, default=16)
+    parser.add_argument("--min-agreement", type=float, default=0.9, help="Minimum mean top-k category agreement")
+    parser.add_argument("--max-perplexity-ratio", type=float, default=1.1, help="Maximum candidate/eager perplexity")
+    parser.add_argument("--skip-clip", action="store_true")
+    parser.add_argument("--skip-llm", action="store_true")
+    args = parser.parse_args(argv)
+
+    images = load_images(args.images, args.num_synthetic)
+    report = {"backend": args.backend, "images": len(images)}
+    passed = True
+
+    reference_analyzer = ImageAnalyzer(backend="torch")
+    reference = reference_analyzer.analyze_batch(images)
+    if not args.skip_clip:
+        candidate = ImageAnalyzer(backend=args.backend).analyze_batch(images)
+        report["clip"] = category_agreement(reference, candidate)
+        passed &= report["clip"]["mean_topk"] >= args.min_agreement
+
+    if not args.skip_llm:
+        reference_generator = CaptionGenerator(backend="torch")
+        prompts = [reference_generator._build_prompt(a, "casual") for a in reference]
+        captions = reference_generator.generate_batch([(a, "casual", 1) for a in reference])
+        texts = [f"{prompt} {caption[0]}" for prompt, caption in zip(prompts, captions)]
+
+        reference_ppl = causal_lm_perplexity(
+            reference_generator.model, reference_generator.tokenizer, texts, reference_generator.device
+        )
+        del reference_generator
+        candidate_generator = CaptionGenerator(backend=args.backend)
+        candidate_ppl = causal_lm_perplexity(
+            candidate_generator.model, candidate_generator.tokenizer, texts, candidate_generator.device
+        )
+        report["llm"] = {
+            "reference_perplexity": reference_ppl,
+            "candidate_perplexity": candidate_ppl,
+            "perplexity_ratio": candidate_ppl / reference_ppl,
+        }
+        passed &= report["llm"]["perplexity_ratio"] <= args.max_perplexity_ratio
+
+    report["passed"] = bool(passed)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Process queued caption jobs without serving HTTP
+
+Workers claim jobs from the SQLite queue at JOB_QUEUE_PATH, which API
+processes started with JOB_WORKERS=0 only fill, so inference capacity can
+be scaled separately from HTTP handling.
+
+Usage:
+    JOB_QUEUE_PATH=jobs.sqlite python job_worker.py --workers 2
+"""
+import os
+import sys
+import asyncio
+import argparse
+from typing import List, Optional
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Process queued caption jobs")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("JOB_WORKERS", "2")))
+    args = parser.parse_args(argv)
+
+    if not os.environ.get("JOB_QUEUE_PATH"):
+        sys.exit("JOB_QUEUE_PATH must point to the SQLite job queue shared with the API")
+
+    # Imported late so the checks above run before the models are set up
+    import app
+
+    app.job_workers.num_workers = args.workers
+    asyncio.run(app.job_workers.run_forever())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Category groups produced by ImageAnalyzer, in prompt matrix order
+GROUPS = ("scenes", "objects", "activities", "moods")
+
+
+class ImageAnalysis:
+    """
+    Result of analyzing one image, passed through the pipeline as is
+
+    Holds the top categories of every group with their scores as float32
+    arrays, the generated description, and the normalized CLIP image
+    embedding, so later stages never have to re-parse strings or re-encode
+    the image.
+    """
+
+    __slots__ = ("description", "labels", "scores", "embedding")
+
+    def __init__(
+        self,
+        description: str,
+        labels: Dict[str, Tuple[str, ...]],
+        scores: Dict[str, np.ndarray],
+        embedding: Optional[np.ndarray] = None
+    ):
+        """
+        Args:
+            description: Human readable description of the image
+            labels: Top categories of each group, best first
+            scores: Scores matching `labels`, one float32 array per group
+            embedding: Normalized CLIP image embedding
+        """
+        self.description = description
+        self.labels = labels
+        self.scores = scores
+        self.embedding = embedding
+
+    @property
+    def scenes(self) -> Tuple[str, ...]:
+        return self.labels.get("scenes", ())
+
+    @property
+    def objects(self) -> Tuple[str, ...]:
+        return self.labels.get("objects", ())
+
+    @property
+    def activities(self) -> Tuple[str, ...]:
+        return self.labels.get("activities", ())
+
+    @property
+    def moods(self) -> Tuple[str, ...]:
+        return self.labels.get("moods", ())
+
+    def top(self, group: str, default: str) -> str:
+        """Best category of a group, or default if the group is empty"""
+        labels = self.labels.get(group, ())
+        return labels[0] if labels else default
+
+    def to_dict(self, include_embedding: bool = False) -> Dict[str, Any]:
+        """
+        Convert to the JSON structure returned by the API
+
+        Args:
+            include_embedding: Also include the embedding (used for persistent caches)
+        """
+        result = {"description": self.description}
+        for group in self.labels:
+            result[group] = [
+                {"category": label, "score": float(score)}
+                for label, score in zip(self.labels[group], self.scores[group])
+            ]
+        if include_embedding and self.embedding is not None:
+            result["embedding"] = self.embedding.tolist()
+        return result
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ImageAnalysis":
+        """Rebuild an analysis from `to_dict` output"""
+        labels, scores = {}, {}
+        for group in GROUPS:
+            items: Sequence[Dict[str, Any]] = data.get(group, [])
+            labels[group] = tuple(item["category"] for item in items)
+            scores[group] = np.array([item["score"] for item in items], dtype=np.float32)
+        embedding = data.get("embedding")
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+        return cls(data["description"], labels, scores, embedding)
+
+    def __str__(self) -> str:
+        return self.description
+
+    def __repr__(self) -> str:
+        return f"ImageAnalysis({self.description!r})"
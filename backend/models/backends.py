@@ -0,0 +1,206 @@
+import io
+import os
+import re
+import shutil
+from typing import Callable, List, Optional
+
+import torch
+import torch.nn as nn
+
+# Inference backend used by ImageAnalyzer and CaptionGenerator:
+# "torch" (eager), "int8" (dynamic int8 quantization) or "onnx" (ONNX Runtime)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+BACKENDS = ("torch", "int8", "onnx")
+
+# Directory used to persist precomputed embeddings and exported graphs between restarts
+CACHE_DIR = os.environ.get(
+    "CAPTION_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "caption-craft")
+)
+
+
+def check_backend(backend: str) -> str:
+    """Validate a backend name"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    return backend
+
+
+def model_dtype(device: str) -> torch.dtype:
+    """Half precision only pays off on GPU; on CPU it is slow or unsupported"""
+    return torch.float16 if device == "cuda" else torch.float32
+
+
+def _quantize(module: nn.Module) -> nn.Module:
+    """Apply dynamic int8 quantization to every Linear layer, in place to avoid a second copy"""
+    return torch.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class _ClipImageEncoder(nn.Module):
+    """Wrap CLIP's encode_image so it can be quantized or exported on its own"""
+
+    def __init__(self, clip_model):
+        super().__init__()
+        self.visual = clip_model.visual
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.visual(pixel_values)
+
+
+class OnnxImageEncoder:
+    """Run CLIP's image encoder with ONNX Runtime"""
+
+    def __init__(self, clip_model, model_name: str, cache_dir: Optional[str]):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx backend requires onnxruntime: pip install onnxruntime")
+
+        resolution = clip_model.visual.input_resolution
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        if not cache_dir:
+            # Nothing to key the graph on, export it in memory
+            graph = io.BytesIO()
+            self._export(clip_model, resolution, graph)
+            self.session = ort.InferenceSession(graph.getvalue(), options, providers=["CPUExecutionProvider"])
+            return
+
+        path = os.path.join(cache_dir, f"clip_visual_{_safe_name(model_name)}_{resolution}.onnx")
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            self._export(clip_model, resolution, tmp_path)
+            os.replace(tmp_path, path)
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    @staticmethod
+    def _export(clip_model, resolution: int, target):
+        """Export the image encoder to a path or file object"""
+        torch.onnx.export(
+            _ClipImageEncoder(clip_model).float().eval(),
+            torch.randn(1, 3, resolution, resolution),
+            target,
+            input_names=["pixel_values"],
+            output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=14
+        )
+
+    def __call__(self, image_input: torch.Tensor) -> torch.Tensor:
+        pixel_values = image_input.detach().cpu().float().numpy()
+        image_embeds = self.session.run(["image_embeds"], {"pixel_values": pixel_values})[0]
+        return torch.from_numpy(image_embeds)
+
+
+def build_image_encoder(
+    clip_model,
+    backend: str,
+    model_name: str,
+    cache_dir: Optional[str]
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    Return the function mapping preprocessed images to CLIP image features
+
+    Text features are only computed once at startup, so they always use the
+    eager model; only the per-request image encoder is swapped.
+
+    Args:
+        clip_model: Eager CLIP model returned by clip.load
+        backend: One of BACKENDS
+        model_name: CLIP model name, used to key exported graphs
+        cache_dir: Directory exported ONNX graphs are cached in (exported in memory if None)
+
+    Returns:
+        Callable taking a (batch, 3, H, W) tensor
+    """
+    check_backend(backend)
+    if backend == "torch":
+        return clip_model.encode_image
+    if backend == "int8":
+        encoder = _quantize(_ClipImageEncoder(clip_model).float().cpu().eval())
+        return lambda image_input: encoder(image_input.cpu().float())
+    return OnnxImageEncoder(clip_model, model_name, cache_dir)
+
+
+def _safe_name(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "-", model_name).strip("-")
+
+
+def load_causal_lm(model_name: str, backend: str, device: str, cache_dir: Optional[str] = CACHE_DIR):
+    """
+    Load the caption language model for the given backend
+
+    Args:
+        model_name: Hugging Face model name
+        backend: One of BACKENDS
+        device: "cuda" or "cpu" (quantized and ONNX models always run on CPU)
+        cache_dir: Directory the ONNX export is cached in (exported on every load if None)
+
+    Returns:
+        A model exposing the transformers `generate` API
+    """
+    check_backend(backend)
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError:
+            raise ImportError("The onnx backend requires optimum: pip install optimum[onnxruntime]")
+        if not cache_dir:
+            return ORTModelForCausalLM.from_pretrained(model_name, export=True, use_cache=True)
+
+        path = os.path.join(cache_dir, f"causal_lm_{_safe_name(model_name)}_onnx")
+        if os.path.exists(path):
+            return ORTModelForCausalLM.from_pretrained(path, use_cache=True)
+
+        # Export once, into a temporary directory renamed into place so
+        # concurrent workers never load a partial export
+        model = ORTModelForCausalLM.from_pretrained(model_name, export=True, use_cache=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            model.save_pretrained(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another worker finished first, or the cache is read-only; caching is an optimization only
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return model
+
+    from transformers import AutoModelForCausalLM
+    # Skip random initialization and load weights straight from the memory-mapped
+    # safetensors checkpoint when the hub provides one
+    load_kwargs = {"low_cpu_mem_usage": True, "use_safetensors": None}
+    if backend == "int8":
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32, **load_kwargs)
+        return _quantize(model.eval())
+
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=model_dtype(device), **load_kwargs)
+    return model.to(device).eval()
+
+
+def backend_device(backend: str, device: str) -> str:
+    """Device inputs must be moved to for a given backend"""
+    return device if backend == "torch" else "cpu"
+
+
+def causal_lm_perplexity(model, tokenizer, texts: List[str], device: str = "cpu") -> float:
+    """
+    Compute the perplexity of a model over a list of texts
+
+    Works for every backend since it only relies on the logits.
+    """
+    total_nll = 0.0
+    total_tokens = 0
+    with torch.no_grad():
+        for text in texts:
+            inputs = tokenizer(text, return_tensors="pt").to(device)
+            input_ids = inputs["input_ids"]
+            if input_ids.shape[1] < 2:
+                continue
+            logits = model(**inputs).logits.float()
+            nll = nn.functional.cross_entropy(
+                logits[0, :-1].cpu(), input_ids[0, 1:].cpu(), reduction="sum"
+            )
+            total_nll += nll.item()
+            total_tokens += input_ids.shape[1] - 1
+    return float(torch.exp(torch.tensor(total_nll / max(1, total_tokens))))
@@ -1,20 +1,150 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoTokenizer, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+)
 import torch
-from typing import List, Dict, Any
+import re
+import time
+import inspect
+from threading import Event, Lock, Thread
+from typing import List, Dict, Any, Tuple, Iterator, Optional, Union
+
+from models.analysis import ImageAnalysis
+from models.backends import INFERENCE_BACKEND, check_backend, backend_device, load_causal_lm
+from utils.metrics import STAGE_SECONDS, TOKENS_GENERATED, timed
+
+# Token limit of a full caption
+DEFAULT_MAX_NEW_TOKENS = 50
+
+SENTENCE_ENDINGS = (".", "!", "?")
+
+
+class StyleProfile:
+    """How long captions of a style may get and when decoding stops"""
+
+    __slots__ = ("max_new_tokens", "max_sentences", "stop_at_newline", "stop_at_hashtag")
+
+    def __init__(
+        self,
+        max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS,
+        max_sentences: Optional[int] = None,
+        stop_at_newline: bool = True,
+        stop_at_hashtag: bool = True
+    ):
+        """
+        Args:
+            max_new_tokens: Token limit of a caption
+            max_sentences: Stop once this many sentences are complete (None disables)
+            stop_at_newline: Stop at the first line break after some text
+            stop_at_hashtag: Stop when a hashtag starts, hashtags are generated separately
+        """
+        self.max_new_tokens = max_new_tokens
+        self.max_sentences = max_sentences
+        self.stop_at_newline = stop_at_newline
+        self.stop_at_hashtag = stop_at_hashtag
+
+
+class StyleStoppingProcessor(LogitsProcessor):
+    """
+    End each sequence of a batch on its own once its caption is complete
+    
+    Forces the EOS token for a sequence that reached its token limit or a
+    stopping point of its style profile. generate stops extending finished
+    sequences and returns as soon as all of them are finished.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        profiles: List[StyleProfile],
+        token_limits: List[int],
+        eos_token_id: int
+    ):
+        """
+        Args:
+            tokenizer: Tokenizer used to decode the newest token of each sequence
+            prompt_length: Length of the (padded) prompt in the generated ids
+            profiles: Style profile of every sequence
+            token_limits: Token limit of every sequence
+            eos_token_id: Token ending a sequence
+        """
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.profiles = profiles
+        self.token_limits = token_limits
+        self.eos_token_id = eos_token_id
+        self.texts = [""] * len(profiles)
+        self.sentences = [0] * len(profiles)
+        self.finished = [False] * len(profiles)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        generated = input_ids.shape[1] - self.prompt_length
+        pieces = self.tokenizer.batch_decode(input_ids[:, -1:], skip_special_tokens=True) if generated > 0 else None
+        for row, profile in enumerate(self.profiles):
+            if not self.finished[row] and pieces is not None:
+                self.finished[row] = self._complete(row, profile, pieces[row])
+            if self.finished[row] or generated >= self.token_limits[row]:
+                self.finished[row] = True
+                scores[row, :] = -float("inf")
+                scores[row, self.eos_token_id] = 0.0
+        return scores
+
+    def _complete(self, row: int, profile: StyleProfile, piece: str) -> bool:
+        """Add the newest token of a sequence and tell whether its caption is complete"""
+        has_text = bool(self.texts[row].strip())
+        self.texts[row] += piece
+        if profile.stop_at_newline and has_text and "\n" in piece:
+            return True
+        if profile.stop_at_hashtag and has_text and "#" in piece:
+            return True
+        if profile.max_sentences and piece.rstrip().endswith(SENTENCE_ENDINGS):
+            self.sentences[row] += 1
+            return self.sentences[row] >= profile.max_sentences
+        return False
+
+class EventStoppingCriteria(StoppingCriteria):
+    """Stop generating once an event is set, e.g. when a stream's client went away"""
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.event.is_set()
+
 
 class CaptionGenerator:
-    def __init__(self):
-        """Initialize the caption generation model"""
-        # Load pretrained model and tokenizer
-        # Using a smaller model for demonstration, but you can replace with larger models
-        model_name = "facebook/opt-350m"  # You can use larger models like "facebook/opt-2.7b" for better results
+    def __init__(
+        self,
+        model_name: str = "facebook/opt-350m",
+        backend: Optional[str] = None,
+        model: Optional[Any] = None,
+        tokenizer: Optional[Any] = None
+    ):
+        """
+        Initialize the caption generation model
         
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float16)
+        Args:
+            model_name: Causal language model to load. Using a smaller model for demonstration,
+                but you can use larger models like "facebook/opt-2.7b" for better results
+            backend: Inference backend, defaults to INFERENCE_BACKEND
+            model: Already built model to use as is instead of loading model_name
+                (e.g. a small random one for benchmarks); requires tokenizer
+            tokenizer: Tokenizer matching model
+        """
+        self.model_name = model_name
+        self.backend = check_backend(backend or INFERENCE_BACKEND)
         
-        # Move model to GPU if available
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = self.model.to(self.device)
+        # Use the GPU if available (quantized and ONNX backends run on CPU)
+        self.device = backend_device(self.backend, "cuda" if torch.cuda.is_available() else "cpu")
+        
+        # Load pretrained model and tokenizer
+        self.tokenizer = tokenizer if tokenizer is not None else AutoTokenizer.from_pretrained(model_name)
+        # Decoder-only models must be left padded when prompts are batched
+        self.tokenizer.padding_side = "left"
+        if model is not None:
+            self.model = model.to(self.device).eval()
+        else:
+            self.model = load_causal_lm(model_name, self.backend, self.device)
         
         # Define style templates
         self.style_templates = {
@@ -26,7 +156,47 @@ class CaptionGenerator:
             "poetic": "Write a poetic and artistic Instagram caption for {image_description}:"
         }
         
-    def generate(self, image_description: str, style: str = "casual", num_captions: int = 3) -> List[str]:
+        # Length limit and stopping points of every style; decoding ends once
+        # a caption is complete instead of running to the limit and trimming
+        self.style_profiles = {
+            "casual": StyleProfile(max_new_tokens=40, max_sentences=2),
+            "professional": StyleProfile(max_new_tokens=50, max_sentences=2),
+            "funny": StyleProfile(max_new_tokens=40, max_sentences=2),
+            "inspirational": StyleProfile(max_new_tokens=50, max_sentences=2),
+            "minimalist": StyleProfile(max_new_tokens=12, max_sentences=1),
+            "poetic": StyleProfile(max_new_tokens=DEFAULT_MAX_NEW_TOKENS, max_sentences=3, stop_at_newline=False)
+        }
+        
+        # Sampling settings shared by the batched and streaming paths
+        self.generation_kwargs = {
+            "max_new_tokens": DEFAULT_MAX_NEW_TOKENS,
+            "temperature": 0.9,  # Higher temperature for more variety
+            "top_p": 0.92,
+            "top_k": 50,
+            "no_repeat_ngram_size": 2,
+            "do_sample": True,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id
+        }
+        
+        # Decoding steps of the last generate_batch call, for load shedding
+        self.last_batch_steps = 0
+        
+        # Key/value states of each template's fixed instruction prefix, computed once.
+        # Only eager models expose their attention cache to reuse.
+        self.prefix_caching = isinstance(self.model, torch.nn.Module)
+        self._prefix_cache = {}
+        self._prefix_lock = Lock()
+        # Models that do not derive positions from the attention mask need explicit position ids
+        self._takes_position_ids = "position_ids" in inspect.signature(self.model.forward).parameters
+        
+    def generate(
+        self,
+        image_description: Union[ImageAnalysis, str],
+        style: str = "casual",
+        num_captions: int = 3,
+        max_new_tokens: Optional[int] = None
+    ) -> List[str]:
         """
         Generate Instagram captions based on image description
         
@@ -34,60 +204,291 @@ class CaptionGenerator:
             image_description: Description of the image
             style: Style of caption to generate
             num_captions: Number of different captions to generate
+            max_new_tokens: Token limit per caption, lowering the style's own limit
             
         Returns:
             List of generated captions
         """
-        # Get the appropriate prompt template for the style
-        template = self.style_templates.get(style, self.style_templates["casual"])
+        return self.generate_batch([(image_description, style, num_captions, max_new_tokens)])[0]
+
+    def generate_batch(self, requests: List[Tuple]) -> List[List[str]]:
+        """
+        Generate captions for several requests with a single generation call
         
-        # Create the prompt
-        prompt = template.format(image_description=image_description)
+        Prompts from different requests and styles are padded into one batch,
+        and the sampled sequences are split back per request.
         
-        captions = []
-        for _ in range(num_captions):
-            # Tokenize the prompt
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-            
-            # Generate text
-            with torch.no_grad():
-                output = self.model.generate(
-                    **inputs,
-                    max_new_tokens=50,
-                    temperature=0.9,  # Higher temperature for more variety
-                    top_p=0.92,
-                    top_k=50,
-                    no_repeat_ngram_size=2,
-                    do_sample=True,
-                    num_return_sequences=1
-                )
-            
-            # Decode the output
-            generated_text = self.tokenizer.decode(output[0], skip_special_tokens=True)
-            
-            # Extract just the caption (remove the prompt)
-            caption = self._extract_caption(generated_text, prompt)
+        Args:
+            requests: List of (image_description, style, num_captions) tuples, optionally
+                with a fourth max_new_tokens element (None for the style's limit)
             
-            # Clean up the caption
-            caption = self._clean_caption(caption)
+        Returns:
+            List of caption lists, one per request, in input order
+        """
+        if not requests:
+            return []
+        
+        styles = [request[1] for request in requests]
+        prompts = [self._build_prompt(request[0], style) for request, style in zip(requests, styles)]
+        counts = [max(0, request[2]) for request in requests]
+        profiles = [self.style_profile(style) for style in styles]
+        token_limits = [
+            self._token_limit(profile, request[3] if len(request) > 3 else None)
+            for request, profile in zip(requests, profiles)
+        ]
+        if sum(counts) == 0:
+            return [[] for _ in requests]
+        
+        if self.prefix_caching:
+            # Run the prompts once and give every sampled caption a copy of their cache
+            inputs = self._prefill(prompts, styles)
+            repeats = torch.tensor(counts, device=self.device)
+            inputs = {key: _repeat_rows(value, repeats) for key, value in inputs.items()}
+            num_return_sequences = 1
+        elif len(set(counts)) == 1:
+            # Same number of captions everywhere, let generate expand the batch
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+            num_return_sequences = counts[0]
+        else:
+            # Tokenize every prompt exactly once, and repeat each
+            # as many times as its request needs captions
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+            repeats = torch.tensor(counts, device=self.device)
+            inputs = {key: value.repeat_interleave(repeats, dim=0) for key, value in inputs.items()}
+            num_return_sequences = 1
+        
+        # Generate text; each sequence ends on its own once its caption is complete,
+        # and the batch stops when all of them have
+        prompt_length = inputs["input_ids"].shape[1]
+        row_limits = [limit for limit, count in zip(token_limits, counts) for _ in range(count)]
+        stopping = StyleStoppingProcessor(
+            self.tokenizer,
+            prompt_length,
+            [profile for profile, count in zip(profiles, counts) for _ in range(count)],
+            row_limits,
+            self.generation_kwargs["eos_token_id"]
+        )
+        generation_kwargs = dict(self.generation_kwargs, max_new_tokens=max(token_limits))
+        start = time.perf_counter()
+        with timed("llm_generate"), torch.no_grad():
+            output = self.model.generate(
+                **inputs,
+                **generation_kwargs,
+                num_return_sequences=num_return_sequences,
+                logits_processor=LogitsProcessorList([stopping])
+            )
+        self.last_batch_steps = output.shape[1] - prompt_length
+        # Sequences are generated together, so each caption is charged an equal share
+        per_caption = (time.perf_counter() - start) / len(output)
+        for _ in range(len(output)):
+            STAGE_SECONDS.observe(per_caption, stage="llm_caption")
+        
+        # Decode only the continuation, the prompt (and its padding) is dropped,
+        # and each sequence is cut at its own request's token limit
+        pad_token_id = self.generation_kwargs["pad_token_id"]
+        TOKENS_GENERATED.inc(sum(
+            int((row[prompt_length:prompt_length + limit] != pad_token_id).sum())
+            for row, limit in zip(output, row_limits)
+        ))
+        texts = self.tokenizer.batch_decode(
+            [row[prompt_length:prompt_length + limit] for row, limit in zip(output, row_limits)],
+            skip_special_tokens=True
+        )
+        
+        # Split the flat list of sequences back per request
+        results = []
+        offset = 0
+        for count in counts:
+            results.append([self._clean_caption(text.strip()) for text in texts[offset:offset + count]])
+            offset += count
             
-            captions.append(caption)
+        return results
+
+    def stream(
+        self,
+        image_description: Union[ImageAnalysis, str],
+        style: str = "casual",
+        num_captions: int = 3,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[Event] = None
+    ) -> Iterator[Tuple[str, int, str]]:
+        """
+        Generate captions one after another, yielding text as it is decoded
+        
+        Args:
+            image_description: Description of the image
+            style: Style of caption to generate
+            num_captions: Number of different captions to generate
+            max_new_tokens: Token limit per caption, lowering the style's own limit
+            stop: Event ending generation within one decoding step once set
             
-        return captions
-    
-    def _extract_caption(self, generated_text: str, prompt: str) -> str:
-        """Extract the generated caption from the full text"""
-        # Remove the prompt from the generated text
-        if generated_text.startswith(prompt):
-            caption = generated_text[len(prompt):].strip()
+        Yields:
+            ("token", index, text) for every decoded chunk of caption `index`,
+            then ("caption", index, caption) with the cleaned caption once it is complete
+        """
+        prompt = self._build_prompt(image_description, style)
+        if self.prefix_caching:
+            # Every caption continues from the same prompt cache, generate does not modify it
+            inputs = self._prefill([prompt], [style])
         else:
-            # If for some reason the prompt is not at the beginning
-            caption = generated_text.replace(prompt, "").strip()
+            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        profile = self.style_profile(style)
+        token_limit = self._token_limit(profile, max_new_tokens)
+        generation_kwargs = dict(self.generation_kwargs, max_new_tokens=token_limit)
+        if stop is not None:
+            generation_kwargs["stopping_criteria"] = StoppingCriteriaList([EventStoppingCriteria(stop)])
+        
+        for index in range(num_captions):
+            if stop is not None and stop.is_set():
+                return
+            # The streamer only supports a batch size of 1, so captions are streamed in turn
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            errors = []
+            stopping = StyleStoppingProcessor(
+                self.tokenizer, inputs["input_ids"].shape[1], [profile], [token_limit],
+                self.generation_kwargs["eos_token_id"]
+            )
+            thread = Thread(
+                target=self._generate_into_streamer,
+                args=(inputs, dict(generation_kwargs, logits_processor=LogitsProcessorList([stopping])), streamer, errors),
+                daemon=True
+            )
+            thread.start()
             
-        return caption
+            text = ""
+            for chunk in streamer:
+                if chunk:
+                    text += chunk
+                    yield "token", index, chunk
+            thread.join()
+            if errors:
+                raise errors[0]
+            
+            yield "caption", index, self._clean_caption(text.strip())
+
+    def _generate_into_streamer(self, inputs, generation_kwargs: Dict[str, Any], streamer: TextIteratorStreamer, errors: list):
+        """Run generation for a single sequence, pushing tokens into the streamer"""
+        try:
+            with timed("llm_caption"), torch.no_grad():
+                output = self.model.generate(**inputs, **generation_kwargs, streamer=streamer)
+            TOKENS_GENERATED.inc(output.shape[1] - inputs["input_ids"].shape[1])
+        except Exception as e:
+            # Hand the error to the consumer and unblock it, it would otherwise wait forever
+            errors.append(e)
+            streamer.end()
+
+    def style_profile(self, style: str) -> StyleProfile:
+        """Generation profile of a style, unknown styles use the casual one"""
+        return self.style_profiles.get(style, self.style_profiles["casual"])
+
+    def _token_limit(self, profile: StyleProfile, max_new_tokens: Optional[int]) -> int:
+        """Token limit of a caption: the style's, lowered further by a request limit"""
+        return min(profile.max_new_tokens, max_new_tokens) if max_new_tokens else profile.max_new_tokens
+
+    def _style_prefix(self, style: str) -> Tuple[List[int], Optional[Tuple]]:
+        """
+        Return the token ids and key/value cache of a style's fixed prefix
+        
+        The prefix is the template text before the image description. It is
+        run through the model once and reused by every later request.
+        """
+        template = self.style_templates.get(style, self.style_templates["casual"])
+        prefix = template.split("{image_description}")[0].rstrip()
+        if not prefix:
+            return [], None
+        
+        with self._prefix_lock:
+            cached = self._prefix_cache.get(prefix)
+            if cached is None:
+                prefix_ids = self.tokenizer(prefix).input_ids
+                with torch.no_grad():
+                    outputs = self.model(torch.tensor([prefix_ids], device=self.device), use_cache=True)
+                cached = self._prefix_cache[prefix] = (prefix_ids, outputs.past_key_values)
+        return cached
+
+    def _prefill(self, prompts: List[str], styles: List[str]) -> Dict[str, Any]:
+        """
+        Build generate inputs whose prompts are already in the attention cache
+        
+        Each row is laid out as [padding, style prefix, padding, rest of the
+        prompt]. The cached prefix states are reused as is, and only the rest
+        of the prompt is run, minus its last token, which generate feeds
+        itself. Positions come from the attention mask, so the padding gaps do
+        not change the result.
+        
+        Returns:
+            input_ids, attention_mask and past_key_values for `generate`
+        """
+        rows = []
+        for prompt, style in zip(prompts, styles):
+            ids = self.tokenizer(prompt).input_ids
+            prefix_ids, prefix_past = self._style_prefix(style)
+            # The cache is only valid if the prompt tokenizes to the same prefix tokens
+            if prefix_past is None or len(ids) <= len(prefix_ids) or ids[:len(prefix_ids)] != prefix_ids:
+                prefix_ids, prefix_past = [], None
+            rows.append((prefix_ids, prefix_past, ids[len(prefix_ids):]))
+        
+        prefix_length = max(len(row[0]) for row in rows)
+        rest_length = max(len(row[2]) for row in rows)
+        input_ids = torch.full(
+            (len(rows), prefix_length + rest_length), self.generation_kwargs["pad_token_id"], dtype=torch.long
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for i, (prefix_ids, _, rest) in enumerate(rows):
+            if prefix_ids:
+                input_ids[i, prefix_length - len(prefix_ids):prefix_length] = torch.tensor(prefix_ids)
+                attention_mask[i, prefix_length - len(prefix_ids):prefix_length] = 1
+            input_ids[i, prefix_length + rest_length - len(rest):] = torch.tensor(rest)
+            attention_mask[i, prefix_length + rest_length - len(rest):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        
+        # Left pad the prefix caches to a common length
+        past = None
+        if prefix_length:
+            reference = next(row[1] for row in rows if row[1] is not None)
+            past = tuple(
+                tuple(
+                    torch.cat([
+                        _left_pad(row[1][layer][i] if row[1] is not None else None, tensor, prefix_length)
+                        for row in rows
+                    ])
+                    for i, tensor in enumerate(layer_past)
+                )
+                for layer, layer_past in enumerate(reference)
+            )
+        
+        # Run the rest of the prompts on top of the prefixes
+        length = prefix_length + rest_length - 1
+        if length > prefix_length:
+            model_kwargs = {}
+            if self._takes_position_ids:
+                model_kwargs["position_ids"] = (attention_mask[:, :length].cumsum(-1) - 1).clamp(min=0)[:, prefix_length:]
+            with timed("llm_prefill"), torch.no_grad():
+                outputs = self.model(
+                    input_ids=input_ids[:, prefix_length:length],
+                    attention_mask=attention_mask[:, :length],
+                    past_key_values=past,
+                    use_cache=True,
+                    **model_kwargs
+                )
+            past = outputs.past_key_values
+        
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "past_key_values": past}
+
+    def _build_prompt(self, image_description: Union[ImageAnalysis, str], style: str) -> str:
+        """Fill in the prompt template for the requested style"""
+        if isinstance(image_description, ImageAnalysis):
+            image_description = image_description.description
+        # Get the appropriate prompt template for the style
+        template = self.style_templates.get(style, self.style_templates["casual"])
+        return template.format(image_description=image_description)
     
     def _clean_caption(self, caption: str) -> str:
         """Clean up the generated caption"""
+        # Drop a hashtag the caption stopped at, hashtags are added separately
+        caption = re.sub(r"(\s*#\w*)+$", "", caption)
+        
         # Remove any trailing incomplete sentences
         if caption and not any(caption.endswith(p) for p in [".", "!", "?"]):
             # Find the last complete sentence
@@ -101,7 +502,7 @@ class CaptionGenerator:
         return caption
 
     # Fallback method for when API models aren't available
-    def generate_fallback(self, image_description: str, style: str = "casual", num_captions: int = 3) -> List[str]:
+    def generate_fallback(self, image_description: Union[ImageAnalysis, str], style: str = "casual", num_captions: int = 3) -> List[str]:
         """Fallback caption generation with predefined templates"""
         templates = {
             "casual": [
@@ -140,10 +541,16 @@ class CaptionGenerator:
         style_templates = templates.get(style, templates["casual"])
         
         # Extract elements from image description
-        elements = image_description.lower().split()
-        image_scene = next((word for word in elements if word in ["beach", "mountains", "city", "forest", "sunset", "home", "office"]), "moment")
-        image_objects = next((word for word in elements if word in ["people", "food", "nature", "buildings", "sunset", "technology"]), "view")
-        image_mood = next((word for word in elements if word in ["happy", "peaceful", "energetic", "calm", "exciting"]), "amazing")
+        if isinstance(image_description, ImageAnalysis):
+            # The analysis already knows its top categories, no need to parse text
+            image_scene = image_description.top("scenes", "moment")
+            image_objects = image_description.top("objects", "view")
+            image_mood = image_description.top("moods", "amazing")
+        else:
+            elements = image_description.lower().split()
+            image_scene = next((word for word in elements if word in ["beach", "mountains", "city", "forest", "sunset", "home", "office"]), "moment")
+            image_objects = next((word for word in elements if word in ["people", "food", "nature", "buildings", "sunset", "technology"]), "view")
+            image_mood = next((word for word in elements if word in ["happy", "peaceful", "energetic", "calm", "exciting"]), "amazing")
         
         # Generate captions
         captions = []
@@ -166,4 +573,20 @@ class CaptionGenerator:
             ) + " ✨"  # Add a small variation
             captions.append(caption)
             
-        return captions
\ No newline at end of file
+        return captions
+
+
+def _left_pad(cache: Optional[torch.Tensor], reference: torch.Tensor, length: int) -> torch.Tensor:
+    """Left pad one row of a (batch, heads, seq, dim) cache tensor to `length` positions"""
+    if cache is None:
+        return reference.new_zeros((1,) + reference.shape[1:-2] + (length, reference.shape[-1]))
+    return torch.nn.functional.pad(cache, (0, 0, length - cache.shape[-2], 0))
+
+
+def _repeat_rows(value: Any, repeats: torch.Tensor) -> Any:
+    """Repeat the rows of a tensor, or of every tensor in a nested cache tuple"""
+    if value is None:
+        return None
+    if isinstance(value, torch.Tensor):
+        return value.repeat_interleave(repeats, dim=0)
+    return tuple(_repeat_rows(item, repeats) for item in value)
@@ -1,15 +1,46 @@
+import os
+import hashlib
 import torch
 import clip
 from PIL import Image
 import numpy as np
-from typing import List, Dict, Any
+from typing import List, Callable, Optional
+
+from models.analysis import ImageAnalysis
+from models.backends import CACHE_DIR, INFERENCE_BACKEND, check_backend, backend_device, build_image_encoder
+from utils.metrics import IMAGES_PROCESSED, timed
 
 class ImageAnalyzer:
-    def __init__(self):
-        """Initialize the CLIP model for image analysis"""
-        # Load the CLIP model
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model, self.preprocess = clip.load("ViT-B/32", device=self.device)
+    def __init__(
+        self,
+        model_name: str = "ViT-B/32",
+        backend: Optional[str] = None,
+        model: Optional[torch.nn.Module] = None,
+        preprocess: Optional[Callable[[Image.Image], torch.Tensor]] = None
+    ):
+        """
+        Initialize the CLIP model for image analysis
+        
+        Args:
+            model_name: CLIP model to load
+            backend: Inference backend for the image encoder, defaults to INFERENCE_BACKEND
+            model: Already built CLIP model to use instead of loading model_name
+                (e.g. a small random one for benchmarks); requires preprocess
+            preprocess: Image transform matching model; injected models are
+                not cached on disk, their name does not identify their weights
+        """
+        # Load the CLIP model (quantized and ONNX backends run on CPU)
+        self.backend = check_backend(backend or INFERENCE_BACKEND)
+        self.device = backend_device(self.backend, "cuda" if torch.cuda.is_available() else "cpu")
+        self.model_name = model_name
+        # Directory for derived artifacts (text embeddings, exported graphs, hashtag embeddings)
+        self.cache_dir = CACHE_DIR if model is None else None
+        if model is not None:
+            self.model, self.preprocess = model.to(self.device).eval(), preprocess
+        else:
+            self.model, self.preprocess = clip.load(model_name, device=self.device)
+        # Side length of the square input the vision encoder expects
+        self.input_resolution = self.model.visual.input_resolution
         
         # Define categories for classification
         self.scene_categories = [
@@ -34,13 +65,102 @@ class ImageAnalyzer:
             "professional", "casual", "serious", "playful", "elegant", "rustic"
         ]
         
-        # Tokenize all categories
-        self.scene_tokens = clip.tokenize(["a photo of " + c for c in self.scene_categories]).to(self.device)
-        self.object_tokens = clip.tokenize(["a photo of " + c for c in self.object_categories]).to(self.device)
-        self.activity_tokens = clip.tokenize(["a photo of people " + c for c in self.activity_categories]).to(self.device)
-        self.mood_tokens = clip.tokenize(["a photo with a " + c + " mood" for c in self.mood_categories]).to(self.device)
+        # Categories of every group and how many top results to keep
+        self.group_top_n = {
+            "scenes": (self.scene_categories, 2),
+            "objects": (self.object_categories, 3),
+            "activities": (self.activity_categories, 1),
+            "moods": (self.mood_categories, 2),
+        }
+        
+        # Prompts for every category group, in the order they are stacked
+        # into the text embedding matrix
+        self.category_prompts = {
+            "scenes": ["a photo of " + c for c in self.scene_categories],
+            "objects": ["a photo of " + c for c in self.object_categories],
+            "activities": ["a photo of people " + c for c in self.activity_categories],
+            "moods": ["a photo with a " + c + " mood" for c in self.mood_categories],
+        }
+        
+        # Row range of each group inside the text embedding matrix
+        self.group_index = {}
+        start = 0
+        for group, prompts in self.category_prompts.items():
+            self.group_index[group] = slice(start, start + len(prompts))
+            start += len(prompts)
+        
+        # Text embeddings never change, so encode them once (or load them from disk)
+        self.text_embeddings = self._load_text_embeddings()
+        
+        # Per-request image encoder for the selected backend
+        self.encode_image = build_image_encoder(self.model, self.backend, model_name, self.cache_dir)
+
+    def _text_cache_path(self, prompts: List[str]) -> Optional[str]:
+        """Return the cache file for the given model and prompt list, None without a cache directory"""
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha256("\n".join([self.model_name] + prompts).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"clip_text_{key[:16]}.pt")
 
-    def analyze(self, image: Image.Image) -> Dict[str, Any]:
+    def _load_text_embeddings(self) -> torch.Tensor:
+        """
+        Build the normalized text embedding matrix for all category prompts
+        
+        The matrix is cached on disk keyed by model name and prompt list, so
+        editing any category list automatically invalidates the cache.
+        
+        Returns:
+            Tensor of shape (num_prompts, embed_dim)
+        """
+        prompts = [p for group in self.category_prompts.values() for p in group]
+        cache_path = self._text_cache_path(prompts)
+        
+        if cache_path is None:
+            return self.encode_text(prompts)
+        
+        if os.path.exists(cache_path):
+            try:
+                embeddings = torch.load(cache_path, map_location=self.device)
+                if embeddings.shape[0] == len(prompts):
+                    return embeddings.to(self.model.dtype)
+            except Exception:
+                # Corrupt or incompatible cache file, rebuild it below
+                pass
+        
+        embeddings = self.encode_text(prompts)
+        
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file first so concurrent workers never read a partial file
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            torch.save(embeddings.cpu(), tmp_path)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Caching is an optimization only; a read-only filesystem is fine
+            pass
+        
+        return embeddings
+
+    def encode_text(self, texts: List[str], batch_size: int = 256) -> torch.Tensor:
+        """
+        Encode texts into normalized CLIP text embeddings
+        
+        Args:
+            texts: Texts to encode (truncated to CLIP's context length)
+            batch_size: Number of texts per forward pass
+            
+        Returns:
+            Tensor of shape (len(texts), embed_dim)
+        """
+        chunks = []
+        with torch.no_grad():
+            for start in range(0, len(texts), batch_size):
+                tokens = clip.tokenize(texts[start:start + batch_size], truncate=True).to(self.device)
+                embeddings = self.model.encode_text(tokens)
+                chunks.append(embeddings / embeddings.norm(dim=-1, keepdim=True))
+        return torch.cat(chunks)
+
+    def analyze(self, image: Image.Image) -> ImageAnalysis:
         """
         Analyze an image and return a description and other attributes
         
@@ -48,53 +168,110 @@ class ImageAnalyzer:
             image: PIL Image object
             
         Returns:
-            Dictionary with image analysis results
+            ImageAnalysis with the top categories, their scores and the image embedding
         """
-        # Preprocess the image
-        image_input = self.preprocess(image).unsqueeze(0).to(self.device)
+        return self.analyze_batch([image])[0]
+
+    def analyze_batch(self, images: List[Image.Image]) -> List[ImageAnalysis]:
+        """
+        Analyze several images with a single batched forward pass
+        
+        Args:
+            images: List of PIL Image objects
+            
+        Returns:
+            List of ImageAnalysis records, one per image, in input order
+        """
+        if not images:
+            return []
+        
+        # Preprocess the images into one batch
+        with timed("clip_preprocess"):
+            image_input = torch.stack([self.preprocess(image) for image in images])
+        return self.analyze_preprocessed(image_input)
+
+    def analyze_preprocessed(self, image_input: torch.Tensor) -> List[ImageAnalysis]:
+        """
+        Analyze a batch of images that already went through `self.preprocess`
+        
+        Args:
+            image_input: Tensor of shape (batch, 3, height, width)
+            
+        Returns:
+            List of ImageAnalysis records, one per image, in input order
+        """
+        image_input = image_input.to(self.device)
         
         # Get image features
-        with torch.no_grad():
-            image_features = self.model.encode_image(image_input)
+        with timed("encode_image"), torch.no_grad():
+            image_features = self.encode_image(image_input).to(self.text_embeddings.dtype)
             image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        
+        IMAGES_PROCESSED.inc(len(image_features))
+        return self.analyze_embeddings(image_features)
+
+    def analyze_embeddings(self, image_features: torch.Tensor) -> List[ImageAnalysis]:
+        """
+        Score normalized image embeddings against every category
+        
+        Args:
+            image_features: Tensor of shape (batch, embed_dim), normalized
             
-            # Get scores for each category
-            scene_scores = 100.0 * image_features @ self.model.encode_text(self.scene_tokens).T
-            object_scores = 100.0 * image_features @ self.model.encode_text(self.object_tokens).T
-            activity_scores = 100.0 * image_features @ self.model.encode_text(self.activity_tokens).T
-            mood_scores = 100.0 * image_features @ self.model.encode_text(self.mood_tokens).T
+        Returns:
+            List of ImageAnalysis records, one per embedding
+        """
+        with timed("category_scoring"):
+            with torch.no_grad():
+                # Score every category of every group with a single matmul
+                scores = 100.0 * image_features.to(self.text_embeddings.dtype) @ self.text_embeddings.T
+            
+            # One device transfer for the whole batch
+            scores = scores.float().cpu().numpy()
+            embeddings = image_features.float().cpu().numpy()
+            return [self._analyze_scores(row, embedding) for row, embedding in zip(scores, embeddings)]
+
+    def combine(self, analyses: List[ImageAnalysis]) -> ImageAnalysis:
+        """
+        Analyze several images as one post, e.g. an Instagram carousel
+        
+        The image embeddings are averaged and renormalized, and the result is
+        scored like a single image, so the post gets one coherent description.
+        
+        Args:
+            analyses: Analyses of the individual images, with their embeddings
             
-        # Get top results
-        top_scenes = self._get_top_results(scene_scores[0], self.scene_categories, 2)
-        top_objects = self._get_top_results(object_scores[0], self.object_categories, 3)
-        top_activities = self._get_top_results(activity_scores[0], self.activity_categories, 1)
-        top_moods = self._get_top_results(mood_scores[0], self.mood_categories, 2)
+        Returns:
+            ImageAnalysis of the whole post
+        """
+        embeddings = np.stack([analysis.embedding for analysis in analyses])
+        mean = embeddings.mean(axis=0)
+        mean = mean / np.linalg.norm(mean)
+        return self.analyze_embeddings(torch.from_numpy(mean[None]).to(self.device))[0]
+
+    def _analyze_scores(self, scores: np.ndarray, embedding: np.ndarray) -> ImageAnalysis:
+        """Turn one row of category scores into an ImageAnalysis"""
+        labels, top_scores = {}, {}
+        for group, (categories, n) in self.group_top_n.items():
+            group_scores = scores[self.group_index[group]]
+            top = np.argsort(-group_scores)[:n]
+            labels[group] = tuple(categories[i] for i in top)
+            top_scores[group] = group_scores[top]
         
         # Generate a structured description
-        description = self._generate_description(top_scenes, top_objects, top_activities, top_moods)
-        
-        return {
-            "description": description,
-            "scenes": top_scenes,
-            "objects": top_objects, 
-            "activities": top_activities,
-            "moods": top_moods
-        }
+        description = self._generate_description(
+            labels["scenes"], labels["objects"], labels["activities"], labels["moods"]
+        )
         
-    def _get_top_results(self, scores, categories, n=3):
-        """Get top n results from scores"""
-        values, indices = scores.topk(n)
-        return [{"category": categories[idx], "score": values[i].item()} 
-                for i, idx in enumerate(indices)]
+        return ImageAnalysis(description, labels, top_scores, embedding)
         
     def _generate_description(self, scenes, objects, activities, moods):
         """Generate a textual description from the detected elements"""
         # Build description parts
-        scene_desc = f"a {scenes[0]['category']} scene" if scenes else ""
+        scene_desc = f"a {scenes[0]} scene" if scenes else ""
         
         # Object description
         if objects:
-            obj_list = [obj["category"] for obj in objects]
+            obj_list = list(objects)
             if len(obj_list) == 1:
                 obj_desc = f"showing {obj_list[0]}"
             else:
@@ -103,10 +280,10 @@ class ImageAnalyzer:
             obj_desc = ""
         
         # Activity description
-        activity_desc = f"with {activities[0]['category']} activity" if activities else ""
+        activity_desc = f"with {activities[0]} activity" if activities else ""
         
         # Mood description
-        mood_desc = f"in a {moods[0]['category']} mood" if moods else ""
+        mood_desc = f"in a {moods[0]} mood" if moods else ""
         
         # Combine all parts, filtering out empty ones
         parts = [p for p in [scene_desc, obj_desc, activity_desc, mood_desc] if p]
@@ -114,4 +291,4 @@ class ImageAnalyzer:
             description = " ".join(parts)
             return description.capitalize()
         else:
-            return "An image"
\ No newline at end of file
+            return "An image"
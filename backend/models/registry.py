@@ -0,0 +1,90 @@
+import threading
+import time
+from typing import Any, Callable, Dict
+
+
+class ModelRegistry:
+    """
+    Load models lazily, at most once, and report their readiness
+
+    Each model is built by its factory on first use. Concurrent callers wait
+    for the same load instead of starting their own.
+    """
+
+    def __init__(self, factories: Dict[str, Callable[[], Any]]):
+        """
+        Args:
+            factories: Mapping of model name to a zero-argument constructor
+        """
+        self.factories = factories
+        self._models = {}
+        self._errors = {}
+        self._load_seconds = {}
+        self._locks = {name: threading.Lock() for name in factories}
+        self._loader = None
+
+    def get(self, name: str) -> Any:
+        """Return the named model, loading it first if needed"""
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._locks[name]:
+            # Another thread may have finished loading while we waited
+            if name not in self._models:
+                start = time.perf_counter()
+                try:
+                    self._models[name] = self.factories[name]()
+                except Exception as e:
+                    self._errors[name] = repr(e)
+                    raise
+                self._errors.pop(name, None)
+                self._load_seconds[name] = time.perf_counter() - start
+        return self._models[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def is_ready(self) -> bool:
+        """True once every model is loaded"""
+        return all(name in self._models for name in self.factories)
+
+    def load_all(self):
+        """Load every model that is not loaded yet"""
+        for name in self.factories:
+            self.get(name)
+
+    def load_in_background(self, on_loaded: Callable[[], None] = None) -> threading.Thread:
+        """
+        Load every model on a background thread
+
+        Does nothing if a background load is already running or has succeeded.
+
+        Args:
+            on_loaded: Optional callback run once all models are loaded (e.g. a warm-up pass)
+        """
+        if self._loader is not None and (self._loader.is_alive() or self.is_ready()):
+            return self._loader
+
+        def run():
+            self.load_all()
+            if on_loaded is not None:
+                on_loaded()
+
+        self._loader = threading.Thread(target=run, name="model-loader", daemon=True)
+        self._loader.start()
+        return self._loader
+
+    def status(self) -> Dict[str, Any]:
+        """Return load state, load time and last error of every model"""
+        status = {}
+        for name in self.factories:
+            if name in self._models:
+                status[name] = {"state": "loaded", "load_seconds": round(self._load_seconds[name], 3)}
+            elif name in self._errors:
+                status[name] = {"state": "failed", "error": self._errors[name]}
+            elif self._locks[name].locked():
+                status[name] = {"state": "loading"}
+            else:
+                status[name] = {"state": "not_loaded"}
+        return status
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.jobs import (
+    DONE, FAILED, QUEUED, RUNNING, JobWorkerPool, MemoryJobQueue, QueueFullError, SQLiteJobQueue
+)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_queue(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "memory":
+            kwargs.pop("lease_seconds", None)
+            return MemoryJobQueue(**kwargs)
+        return SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), **kwargs)
+    return make
+
+
+def test_claim_drains_highest_priority_first(make_queue):
+    queue = make_queue()
+    low = queue.submit(b"1", {}, "low", "a")
+    normal = queue.submit(b"2", {}, "normal", "a")
+    high = queue.submit(b"3", {}, "high", "a")
+
+    assert [queue.claim().id for _ in range(3)] == [high.id, normal.id, low.id]
+    assert queue.claim() is None
+
+
+def test_claim_returns_payload(make_queue):
+    queue = make_queue()
+    job = queue.submit(b"image", {"style": "casual"}, "normal", "a")
+
+    claimed = queue.claim()
+    assert claimed.id == job.id
+    assert claimed.payload == b"image"
+    assert claimed.params == {"style": "casual"}
+    assert claimed.status == RUNNING
+    assert claimed.attempts == 1
+
+
+def test_queued_cap_per_client(make_queue):
+    queue = make_queue(max_queued_per_client=2)
+    queue.submit(b"", {}, "normal", "a")
+    queue.submit(b"", {}, "normal", "a")
+    with pytest.raises(QueueFullError):
+        queue.submit(b"", {}, "normal", "a")
+    # Other clients are not affected
+    queue.submit(b"", {}, "normal", "b")
+
+
+def test_running_cap_per_client(make_queue):
+    queue = make_queue()
+    first = queue.submit(b"", {}, "high", "a")
+    queue.submit(b"", {}, "high", "a")
+    other = queue.submit(b"", {}, "low", "b")
+
+    assert queue.claim(max_running_per_client=1).id == first.id
+    # Client a is at its cap, so b's lower priority job runs next
+    assert queue.claim(max_running_per_client=1).id == other.id
+    assert queue.claim(max_running_per_client=1) is None
+
+    queue.complete(first.id, {})
+    assert queue.claim(max_running_per_client=1) is not None
+
+
+def test_complete_and_fail(make_queue):
+    queue = make_queue()
+    done = queue.submit(b"", {}, "normal", "a", client_label="alice")
+    failed = queue.submit(b"", {}, "normal", "a")
+    queue.claim()
+    queue.claim()
+
+    assert queue.complete(done.id, {"captions": ["hi"]})
+    assert queue.fail(failed.id, "boom")
+    # Finishing twice is a no-op
+    assert not queue.complete(done.id, {})
+
+    data = queue.get(done.id).to_dict()
+    assert data["status"] == DONE
+    assert data["result"] == {"captions": ["hi"]}
+    assert data["client_id"] == "alice"
+    assert queue.get(failed.id).to_dict()["error"] == "boom"
+    assert queue.get(failed.id).status == FAILED
+
+
+def test_get_skips_payload(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite"))
+    job = queue.submit(b"image", {}, "normal", "a")
+
+    fetched = queue.get(job.id)
+    assert fetched.status == QUEUED
+    assert fetched.payload is None
+
+
+def test_expired_lease_requeues_and_counts_attempts(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=0.05)
+    job = queue.submit(b"", {}, "normal", "a")
+
+    first = queue.claim()
+    time.sleep(0.1)
+    second = queue.claim()
+    assert second.id == job.id
+    assert (first.attempts, second.attempts) == (1, 2)
+
+    # The lost attempt can neither renew nor finish the job
+    assert not queue.renew(job.id, first.attempts)
+    assert not queue.complete(job.id, {"from": "first"}, first.attempts)
+    assert queue.complete(job.id, {"from": "second"}, second.attempts)
+    assert queue.get(job.id).result == {"from": "second"}
+
+
+def test_renew_keeps_the_lease(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=0.2)
+    job = queue.submit(b"", {}, "normal", "a")
+    claimed = queue.claim()
+
+    for _ in range(3):
+        time.sleep(0.1)
+        assert queue.renew(job.id, claimed.attempts)
+    assert queue.claim() is None
+
+
+def test_worker_pool_renews_long_jobs(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=0.3)
+    job = queue.submit(b"", {}, "normal", "a")
+    attempts = []
+
+    async def handler(job):
+        attempts.append(job.attempts)
+        await asyncio.sleep(1.0)
+        return {"ok": True}
+
+    async def run():
+        pool = JobWorkerPool(queue, handler, num_workers=2, poll_interval=0.05)
+        pool.start()
+        await asyncio.sleep(1.5)
+        for task in pool._tasks:
+            task.cancel()
+        return pool
+
+    pool = asyncio.run(run())
+    assert attempts == [1]
+    assert queue.get(job.id).status == DONE
+    assert pool.jobs_done == 1
+
+
+def test_worker_pool_records_failures(make_queue):
+    queue = make_queue()
+    job = queue.submit(b"", {}, "normal", "a")
+
+    async def handler(job):
+        raise ValueError("not an image")
+
+    async def run():
+        pool = JobWorkerPool(queue, handler, num_workers=1, poll_interval=0.05)
+        pool.start()
+        await asyncio.sleep(0.3)
+        for task in pool._tasks:
+            task.cancel()
+        return pool
+
+    pool = asyncio.run(run())
+    assert queue.get(job.id).error == "not an image"
+    assert pool.jobs_failed == 1
@@ -0,0 +1,140 @@
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+
+class MicroBatcher:
+    """
+    Collect items submitted by concurrent requests and process them in batches
+
+    Items are queued until either `max_batch_size` items are pending or the
+    oldest item has waited `max_wait_ms`. The batch function then runs once on
+    a worker thread, off the event loop, and each caller receives its own result.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        executor: Optional[ThreadPoolExecutor] = None,
+        name: str = "batcher"
+    ):
+        """
+        Args:
+            batch_fn: Function mapping a list of items to a list of results of the same length
+            max_batch_size: Maximum number of items processed in one call
+            max_wait_ms: Maximum time the first item of a batch waits for company
+            executor: Executor running batch_fn (defaults to a dedicated single thread)
+            name: Name used in stats output
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.name = name
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        # Stats
+        self.batch_size_histogram = Counter()
+        self.queue_depth_histogram = Counter()
+        self.items_processed = 0
+        self.batches_processed = 0
+        self.in_flight = 0
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Queue an item and wait for its result
+
+        Args:
+            item: Input passed to batch_fn together with other pending items
+
+        Returns:
+            The result produced by batch_fn for this item
+        """
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    def _ensure_worker(self):
+        """Start the batching loop on the running event loop if needed"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        """Form batches from the queue and dispatch them to the executor"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            # Keep collecting until the batch is full or the deadline passes
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Drain anything that arrived in the meantime without waiting
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            self.queue_depth_histogram[self._queue.qsize()] += 1
+            self.batch_size_histogram[len(batch)] += 1
+
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            self.in_flight = len(items)
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+                if len(results) != len(items):
+                    raise RuntimeError(
+                        f"{self.name}: batch function returned {len(results)} results for {len(items)} items"
+                    )
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.in_flight = 0
+
+            self.items_processed += len(items)
+            self.batches_processed += 1
+            for future, result in zip(futures, results):
+                # The caller may have been cancelled while the batch was running
+                if not future.done():
+                    future.set_result(result)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of items waiting to be batched"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def pending(self) -> int:
+        """Number of items waiting or currently being processed"""
+        return self.queue_depth + self.in_flight
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth and batch size statistics"""
+        return {
+            "name": self.name,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "items_processed": self.items_processed,
+            "batches_processed": self.batches_processed,
+            "mean_batch_size": self.items_processed / self.batches_processed if self.batches_processed else 0.0,
+            "batch_size_histogram": dict(sorted(self.batch_size_histogram.items())),
+            "queue_depth_histogram": dict(sorted(self.queue_depth_histogram.items())),
+        }
@@ -0,0 +1,310 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from models.analysis import ImageAnalysis
+from utils.metrics import CACHE_REQUESTS
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with size and TTL eviction"""
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl_seconds: Optional[float] = 3600.0,
+        max_bytes: Optional[int] = None,
+        sizeof: Optional[Callable[[Any], int]] = None
+    ):
+        """
+        Args:
+            max_size: Maximum number of entries kept in memory
+            ttl_seconds: Time after which an entry expires (None disables expiry)
+            max_bytes: Maximum total size of the entries (None disables the byte budget)
+            sizeof: Returns the size of a value in bytes, required with max_bytes
+        """
+        self.max_size = max(1, max_size)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any):
+        """Store value under key, evicting the least recently used entries if full"""
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._data) > self.max_size or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        """Delete an entry and release its bytes, the lock must be held"""
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return size and hit/miss counters"""
+        return {
+            "backend": "memory",
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SQLiteCache:
+    """
+    SQLite-backed cache that can be shared by several worker processes
+
+    Values must be JSON serializable. Lookups only read: the recency of hit
+    entries is kept in memory and written with the next set().
+    """
+
+    def __init__(self, path: str, max_size: int = 100000, ttl_seconds: Optional[float] = 3600.0):
+        """
+        Args:
+            path: Path of the SQLite database file
+            max_size: Maximum number of rows kept in the table
+            ttl_seconds: Time after which an entry expires (None disables expiry)
+        """
+        self.path = path
+        self.max_size = max(1, max_size)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # key -> time of the last hit, not yet written to accessed_at
+        self._touched = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = row
+            if expires_at is not None and expires_at < now:
+                # Deleted by the next set(), along with every other expired row
+                self.misses += 1
+                return None
+
+            self._touched[key] = now
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, value: Any):
+        """Store value under key, evicting expired and least recently used rows if full"""
+        now = time.time()
+        expires_at = now + self.ttl_seconds if self.ttl_seconds else None
+        payload = json.dumps(value)
+        with self._lock:
+            if self._touched:
+                # Written before the insert so the new row keeps its own time
+                self._conn.executemany(
+                    "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                    [(accessed_at, touched_key) for touched_key, accessed_at in self._touched.items()]
+                )
+                self._touched.clear()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, payload, expires_at, now)
+            )
+            removed = self._conn.execute(
+                "DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (now,)
+            ).rowcount
+            overflow = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_size
+            if overflow > 0:
+                removed += self._conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY accessed_at ASC LIMIT ?)", (overflow,)
+                ).rowcount
+            self._conn.commit()
+            self.evictions += max(0, removed)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return size and hit/miss counters"""
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "size": len(self),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class TieredCache:
+    """In-process LRU in front of an optional shared backend"""
+
+    def __init__(
+        self,
+        memory: LRUCache,
+        shared: Optional[SQLiteCache] = None,
+        dumps: Optional[Callable[[Any], Any]] = None,
+        loads: Optional[Callable[[Any], Any]] = None
+    ):
+        """
+        Args:
+            memory: In-process cache, stores values as is
+            shared: Optional shared backend
+            dumps: Converts a value to something JSON serializable for the shared backend
+            loads: Reverses `dumps`
+        """
+        self.memory = memory
+        self.shared = shared
+        self.dumps = dumps or (lambda value: value)
+        self.loads = loads or (lambda value: value)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Look the key up in memory first, then in the shared backend"""
+        value = self.memory.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                value = self.loads(value)
+                # Promote so the next lookup stays in process
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key: str, value: Any):
+        """Store the value in every tier"""
+        self.memory.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, self.dumps(value))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return counters for every tier"""
+        stats = {"memory": self.memory.stats()}
+        if self.shared is not None:
+            stats["shared"] = self.shared.stats()
+        return stats
+
+
+def hash_bytes(data: bytes) -> str:
+    """Return the content hash used to key images"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-level cache for the /analyze pipeline
+
+    - image hash -> ImageAnalyzer.analyze result
+    - (description, style, num_captions) -> captions
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: Optional[float] = 3600.0, path: Optional[str] = None):
+        """
+        Args:
+            max_size: Maximum number of entries per level in memory
+            ttl_seconds: Time after which entries expire
+            path: Optional SQLite database shared between workers
+        """
+        def make_level(name, dumps=None, loads=None):
+            shared = None
+            if path:
+                root, ext = os.path.splitext(path)
+                shared = SQLiteCache(f"{root}-{name}{ext or '.sqlite'}", ttl_seconds=ttl_seconds)
+            return TieredCache(LRUCache(max_size, ttl_seconds), shared, dumps, loads)
+
+        # Analyses are kept as objects in memory and as JSON (with their embedding) when shared
+        self.analysis = make_level(
+            "analysis",
+            dumps=lambda analysis: analysis.to_dict(include_embedding=True),
+            loads=ImageAnalysis.from_dict
+        )
+        self.captions = make_level("captions")
+
+    @staticmethod
+    def caption_key(image_description: Any, style: str, num_captions: int) -> str:
+        """Build the caption cache key"""
+        if isinstance(image_description, ImageAnalysis):
+            image_description = image_description.description
+        return hash_bytes(json.dumps([str(image_description), style, num_captions]).encode("utf-8"))
+
+    def get_analysis(self, image_hash: str) -> Optional[ImageAnalysis]:
+        analysis = self.analysis.get(image_hash)
+        CACHE_REQUESTS.inc(level="analysis", result="miss" if analysis is None else "hit")
+        return analysis
+
+    def set_analysis(self, image_hash: str, analysis: ImageAnalysis):
+        self.analysis.set(image_hash, analysis)
+
+    def get_captions(self, image_description: Any, style: str, num_captions: int) -> Optional[list]:
+        captions = self.captions.get(self.caption_key(image_description, style, num_captions))
+        CACHE_REQUESTS.inc(level="captions", result="miss" if captions is None else "hit")
+        return captions
+
+    def set_captions(self, image_description: Any, style: str, num_captions: int, captions: list):
+        self.captions.set(self.caption_key(image_description, style, num_captions), captions)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters for both levels"""
+        return {
+            "analysis": self.analysis.stats(),
+            "captions": self.captions.stats(),
+        }
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.cache import LRUCache
+from utils.hashtag_utils import HASHTAG_CATEGORIES, TRENDING_HASHTAGS
+
+# Optional file with extra tags: one per line, or a JSON list
+HASHTAG_FILE = os.environ.get("HASHTAG_FILE")
+
+# Prompt each tag is embedded with
+TAG_PROMPT = "a photo of {tag}"
+
+
+def normalize_tag(tag: str) -> str:
+    """Strip the leading # and surrounding whitespace, lowercase"""
+    return tag.strip().lstrip("#").strip().lower()
+
+
+def load_tag_file(path: str) -> List[str]:
+    """Read custom tags from a text file (one per line) or a JSON list"""
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".json"):
+        return list(json.loads(content))
+    return [line for line in content.splitlines() if line.strip() and not line.startswith("//")]
+
+
+def default_vocabulary(extra_file: Optional[str] = HASHTAG_FILE) -> List[str]:
+    """All built-in category and trending tags, plus the custom tag file if configured"""
+    tags = [tag for category_tags in HASHTAG_CATEGORIES.values() for tag in category_tags]
+    tags.extend(TRENDING_HASHTAGS)
+    if extra_file:
+        tags.extend(load_tag_file(extra_file))
+    return tags
+
+
+class HashtagIndex:
+    """
+    Rank hashtags by similarity to an image or description embedding
+
+    Every tag is embedded once into a normalized float32 matrix that is cached
+    on disk and memory-mapped on later starts. A query is a single matrix-vector
+    product followed by an O(n) argpartition, so lookups stay fast with 100k+ tags.
+    """
+
+    def __init__(self, tags: List[str], embeddings: np.ndarray, encode_fn: Optional[Callable] = None):
+        """
+        Args:
+            tags: Tag vocabulary (without #)
+            embeddings: Normalized matrix of shape (len(tags), embed_dim)
+            encode_fn: Function mapping a list of texts to normalized embeddings, for text queries
+        """
+        self.tags = tags
+        self.embeddings = embeddings
+        self.encode_fn = encode_fn
+        # Text queries repeat a lot (descriptions come from a small vocabulary)
+        self._query_cache = LRUCache(max_size=4096, ttl_seconds=None)
+
+    @classmethod
+    def build(
+        cls,
+        tags: Iterable[str],
+        encode_fn: Callable[[List[str]], np.ndarray],
+        model_name: str,
+        cache_dir: Optional[str] = None
+    ) -> "HashtagIndex":
+        """
+        Embed a tag vocabulary, reusing the on-disk cache when possible
+
+        Args:
+            tags: Tags with or without a leading #, duplicates are dropped
+            encode_fn: Function mapping a list of texts to normalized embeddings
+            model_name: Name of the embedding model, part of the cache key
+            cache_dir: Directory for the cached matrix (no caching if None)
+        """
+        unique_tags = list(dict.fromkeys(t for t in (normalize_tag(tag) for tag in tags) if t))
+
+        cache_path = None
+        if cache_dir:
+            key_source = "\n".join([model_name, TAG_PROMPT] + unique_tags)
+            key = hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(cache_dir, f"hashtags_{key[:16]}.npy")
+
+            if os.path.exists(cache_path):
+                try:
+                    # Memory-mapped, so forked workers share the pages
+                    embeddings = np.load(cache_path, mmap_mode="r")
+                    if embeddings.shape[0] == len(unique_tags):
+                        return cls(unique_tags, embeddings, encode_fn)
+                except (OSError, ValueError):
+                    # Corrupt cache file, rebuild it below
+                    pass
+
+        embeddings = np.asarray(
+            encode_fn([TAG_PROMPT.format(tag=tag) for tag in unique_tags]), dtype=np.float32
+        )
+
+        if cache_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+                np.save(tmp_path, embeddings)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass
+
+        return cls(unique_tags, embeddings, encode_fn)
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def embed_text(self, text: str) -> np.ndarray:
+        """Embed a text query, memoizing repeated texts"""
+        if self.encode_fn is None:
+            raise ValueError("This index was built without an encoder and only accepts embeddings")
+        embedding = self._query_cache.get(text)
+        if embedding is None:
+            embedding = np.asarray(self.encode_fn([text]), dtype=np.float32)[0]
+            self._query_cache.set(text, embedding)
+        return embedding
+
+    def search(self, embedding: np.ndarray, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Return the k tags most similar to an embedding
+
+        Args:
+            embedding: Query vector of shape (embed_dim,) or batch of shape (n, embed_dim)
+            k: Number of tags to return
+
+        Returns:
+            List of (tag, score) sorted by descending score, or a list of such lists for a batch
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        single = query.ndim == 1
+        query = np.atleast_2d(query)
+        query = query / np.maximum(np.linalg.norm(query, axis=1, keepdims=True), 1e-12)
+
+        # (n, num_tags) cosine similarities in one matmul
+        scores = query @ self.embeddings.T
+        k = max(0, min(k, scores.shape[1]))
+        if k == 0:
+            return [] if single else [[] for _ in range(len(query))]
+
+        # Partial selection is O(num_tags); only the k winners get sorted
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        results = [
+            [(self.tags[i], float(score)) for i, score in zip(row, row_scores)]
+            for row, row_scores in zip(top, top_scores)
+        ]
+        return results[0] if single else results
+
+    def search_text(self, text: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Return the k tags most similar to a text"""
+        return self.search(self.embed_text(text), k)
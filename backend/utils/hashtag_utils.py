@@ -1,5 +1,6 @@
+import re
 import random
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Tuple
 
 # Dictionary of common hashtags by category
 HASHTAG_CATEGORIES = {
@@ -64,6 +65,106 @@ TRENDING_HASHTAGS = [
     "throwbackthursday", "tbt", "flashbackfriday", "weekendvibes", "sundayfunday"
 ]
 
+# Keywords to category mapping
+KEYWORD_MAPPING = {
+    "nature": ["nature", "outdoor", "landscape", "mountain", "beach", "ocean", "sunset", "sunrise", 
+              "sky", "cloud", "forest", "hiking", "wildlife", "wilderness", "tree", "flower", "plant"],
+    "urban": ["city", "urban", "street", "building", "skyscraper", "downtown", "architecture"],
+    "food": ["food", "eat", "drink", "meal", "breakfast", "lunch", "dinner", "dessert", "restaurant", "cafe"],
+    "portrait": ["person", "people", "portrait", "selfie", "face", "smile", "model", "fashion"],
+    "lifestyle": ["lifestyle", "home", "living", "happy", "relax", "mindful", "positive"],
+    "travel": ["travel", "adventure", "explore", "journey", "destination", "vacation", "holiday", "tourism"],
+    "fitness": ["fitness", "gym", "workout", "exercise", "training", "sport", "run", "yoga"],
+    "pets": ["pet", "dog", "cat", "animal"],
+    "creative": ["art", "creative", "design", "drawing", "painting", "artistic"],
+    "technology": ["technology", "tech", "gadget", "device", "computer", "phone", "digital"],
+    "events": ["party", "celebration", "wedding", "birthday", "concert", "festival", "event"],
+    "business": ["business", "work", "professional", "office", "meeting", "presentation"]
+}
+
+# Inflections of keywords besides their plural, listed per keyword: blind
+# suffixing turns "pet" into "peter" and "run" into "runes"
+KEYWORD_FORMS = {
+    "eat": ["eating", "ate", "eaten"],
+    "drink": ["drinking", "drank"],
+    "hiking": ["hike", "hikes", "hiked", "hiker", "hikers"],
+    "smile": ["smiling", "smiled"],
+    "relax": ["relaxing", "relaxed"],
+    "travel": ["traveling", "travelling", "traveled", "travelled", "traveler", "travelers", "traveller", "travellers"],
+    "explore": ["exploring", "explored", "explorer", "explorers"],
+    "exercise": ["exercising", "exercised"],
+    "run": ["running", "runner", "runners", "ran"],
+    "design": ["designing", "designed", "designer", "designers"],
+    "work": ["working", "worked", "worker", "workers"],
+    "celebration": ["celebrate", "celebrates", "celebrating", "celebrated"],
+}
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+def _plural(word: str) -> str:
+    """Regular English plural (or third person singular) of a word"""
+    if word.endswith(("s", "x", "z", "ch", "sh")):
+        return word + "es"
+    if word.endswith("y") and len(word) > 2 and word[-2] not in "aeiou":
+        # party -> parties
+        return word[:-1] + "ies"
+    return word + "s"
+
+def _word_forms(word: str) -> List[str]:
+    """A keyword, its plural and the inflections listed in KEYWORD_FORMS"""
+    return [word, _plural(word)] + KEYWORD_FORMS.get(word, [])
+
+def compile_keyword_matcher(mapping: Dict[str, List[str]]) -> Dict[Tuple[str, ...], Tuple[str, ...]]:
+    """
+    Compile a keyword mapping into a lookup table from word sequences to categories
+    
+    Keywords only match whole words (with common inflections), and phrases
+    are matched as consecutive words.
+    
+    Args:
+        mapping: Category to keyword list
+        
+    Returns:
+        Dictionary from a tuple of words to the categories it belongs to
+    """
+    table = {}
+    for category, keywords in mapping.items():
+        for keyword in keywords:
+            words = _WORD_PATTERN.findall(keyword.lower())
+            if not words:
+                continue
+            # Only the last word of a phrase is inflected
+            for form in _word_forms(words[-1]):
+                key = tuple(words[:-1]) + (form,)
+                if category not in table.setdefault(key, ()):
+                    table[key] = table[key] + (category,)
+    return table
+
+# Compiled once at import time
+_KEYWORD_TABLE = compile_keyword_matcher(KEYWORD_MAPPING)
+_MAX_PHRASE_WORDS = max((len(key) for key in _KEYWORD_TABLE), default=1)
+_CATEGORY_ORDER = {category: i for i, category in enumerate(KEYWORD_MAPPING)}
+
+def match_categories(description: str) -> Dict[str, int]:
+    """
+    Find the keyword categories a description mentions, in a single pass over its words
+    
+    Args:
+        description: Image description
+        
+    Returns:
+        Dictionary of category to number of keyword hits, in KEYWORD_MAPPING order
+    """
+    words = _WORD_PATTERN.findall(description.lower())
+    counts = {}
+    for i in range(len(words)):
+        for length in range(1, _MAX_PHRASE_WORDS + 1):
+            categories = _KEYWORD_TABLE.get(tuple(words[i:i + length]))
+            if categories:
+                for category in categories:
+                    counts[category] = counts.get(category, 0) + 1
+    return dict(sorted(counts.items(), key=lambda item: _CATEGORY_ORDER[item[0]]))
+
 def map_description_to_categories(description: str) -> List[str]:
     """
     Map image description to relevant hashtag categories
@@ -74,31 +175,8 @@ def map_description_to_categories(description: str) -> List[str]:
     Returns:
         List of relevant hashtag categories
     """
-    # Convert description to lowercase for easier matching
-    desc_lower = description.lower()
-    
-    # Keywords to category mapping
-    keyword_mapping = {
-        "nature": ["nature", "outdoor", "landscape", "mountain", "beach", "ocean", "sunset", "sunrise", 
-                  "sky", "cloud", "forest", "hiking", "wildlife", "wilderness", "tree", "flower", "plant"],
-        "urban": ["city", "urban", "street", "building", "skyscraper", "downtown", "architecture"],
-        "food": ["food", "eat", "drink", "meal", "breakfast", "lunch", "dinner", "dessert", "restaurant", "cafe"],
-        "portrait": ["person", "people", "portrait", "selfie", "face", "smile", "model", "fashion"],
-        "lifestyle": ["lifestyle", "home", "living", "happy", "relax", "mindful", "positive"],
-        "travel": ["travel", "adventure", "explore", "journey", "destination", "vacation", "holiday", "tourism"],
-        "fitness": ["fitness", "gym", "workout", "exercise", "training", "sport", "run", "yoga"],
-        "pets": ["pet", "dog", "cat", "animal"],
-        "creative": ["art", "creative", "design", "drawing", "painting", "artistic"],
-        "technology": ["technology", "tech", "gadget", "device", "computer", "phone", "digital"],
-        "events": ["party", "celebration", "wedding", "birthday", "concert", "festival", "event"],
-        "business": ["business", "work", "professional", "office", "meeting", "presentation"]
-    }
-    
     # Find matching categories
-    matching_categories = []
-    for category, keywords in keyword_mapping.items():
-        if any(keyword in desc_lower for keyword in keywords):
-            matching_categories.append(category)
+    matching_categories = list(match_categories(description))
     
     # Always include popular hashtags
     matching_categories.append("popular")
@@ -109,17 +187,54 @@ def map_description_to_categories(description: str) -> List[str]:
     
     return matching_categories
 
-def generate_hashtags(description: str, count: int = 10) -> List[str]:
+def map_descriptions_to_categories(descriptions: Iterable[str]) -> List[List[str]]:
+    """
+    Map many descriptions to hashtag categories at once
+    
+    Descriptions generated from CLIP categories repeat a lot, so each distinct
+    description is only matched once.
+    
+    Args:
+        descriptions: Image descriptions
+        
+    Returns:
+        List of category lists, one per description, in input order
+    """
+    memo = {}
+    results = []
+    for description in descriptions:
+        if description not in memo:
+            memo[description] = map_description_to_categories(description)
+        results.append(list(memo[description]))
+    return results
+
+def generate_hashtags(description: Any, count: int = 10, embedding=None, index=None) -> List[str]:
     """
     Generate Instagram hashtags based on image description
     
     Args:
-        description: Image description
+        description: Image description, or an ImageAnalysis (its embedding is then used by default)
         count: Number of hashtags to generate
+        embedding: Optional image embedding to rank tags against
+        index: Optional HashtagIndex; when given, tags are ranked by embedding
+            similarity instead of keyword matching
         
     Returns:
         List of hashtags
     """
+    if not isinstance(description, str):
+        # Structured analysis record: use its fields directly
+        if embedding is None:
+            embedding = getattr(description, "embedding", None)
+        description = description.description
+    
+    if index is not None:
+        if embedding is not None:
+            ranked = index.search(embedding, count)
+        else:
+            ranked = index.search_text(description, count)
+        return [f"#{tag}" for tag, _ in ranked]
+    
     # Map description to relevant categories
     categories = map_description_to_categories(description)
     
@@ -0,0 +1,67 @@
+import io
+import os
+from typing import Union
+
+from PIL import Image
+
+# Limits protecting against decompression bombs and oversized uploads
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(50_000_000)))
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(25 * 1024 * 1024)))
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image exceeds the configured byte or pixel budget"""
+
+
+def load_image(
+    source: Union[bytes, str],
+    target_size: int = 224,
+    max_pixels: int = MAX_IMAGE_PIXELS,
+    max_bytes: int = MAX_IMAGE_BYTES
+) -> Image.Image:
+    """
+    Decode an image straight to (roughly) the size the models need
+
+    JPEGs are decoded in draft mode, which lets libjpeg downscale by 1/2, 1/4
+    or 1/8 while decoding, and the result is then reduced so its short side is
+    `target_size`. Pixels that CLIP would throw away are never materialized.
+
+    Args:
+        source: Encoded image bytes or a file path
+        target_size: Minimum length of the short side after decoding
+        max_pixels: Maximum width * height of the encoded image
+        max_bytes: Maximum size of the encoded image
+
+    Returns:
+        RGB PIL Image whose short side is at most target_size (unless the original was smaller)
+
+    Raises:
+        ImageTooLargeError: If the image exceeds the byte or pixel budget
+        PIL.UnidentifiedImageError: If the data is not a supported image
+    """
+    num_bytes = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+    if num_bytes > max_bytes:
+        raise ImageTooLargeError(f"Image is {num_bytes} bytes, the limit is {max_bytes}")
+
+    # Opening only parses the header, so the size check happens before any decoding.
+    # Pillow refuses images far beyond its own limit while opening them
+    try:
+        image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    width, height = image.size
+    if width * height > max_pixels:
+        image.close()
+        raise ImageTooLargeError(f"Image is {width}x{height} pixels, the limit is {max_pixels} pixels")
+
+    # No-op for formats other than JPEG
+    image.draft("RGB", (target_size, target_size))
+    image = image.convert("RGB")
+
+    # Downscale the rest of the way; reducing_gap does a fast box reduction first
+    scale = target_size / min(image.size)
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.BICUBIC, reducing_gap=2.0)
+
+    return image
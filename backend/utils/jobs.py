@@ -0,0 +1,627 @@
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Webhook hosts allowed even on private addresses, comma separated (empty allows public hosts only)
+WEBHOOK_ALLOWED_HOSTS = {
+    host.strip().lower() for host in os.environ.get("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()
+}
+
+# Columns loaded into a Job, the payload is only read when a job is claimed
+JOB_COLUMNS = (
+    "id, priority, client_id, params, webhook_url, status, result, error, "
+    "created_at, started_at, finished_at, client_label, attempts"
+)
+
+# Priority lanes, drained in this order
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    """Raised when a client already has too many jobs waiting"""
+
+
+class Job:
+    """One queued caption request and its outcome"""
+
+    __slots__ = (
+        "id", "priority", "client_id", "params", "payload", "webhook_url", "status",
+        "result", "error", "created_at", "started_at", "finished_at", "client_label", "attempts"
+    )
+
+    def __init__(
+        self,
+        id: str,
+        priority: str,
+        client_id: str,
+        params: Dict[str, Any],
+        payload: Optional[bytes],
+        webhook_url: Optional[str] = None,
+        status: str = QUEUED,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+        created_at: Optional[float] = None,
+        started_at: Optional[float] = None,
+        finished_at: Optional[float] = None,
+        client_label: Optional[str] = None,
+        attempts: int = 0
+    ):
+        """
+        Args:
+            client_id: Key of the per-client caps, taken from the connection and not the request body
+            client_label: Client name given by the caller, only reported back
+            attempts: Times the job was claimed, above 1 when it was retried after its worker was lost
+        """
+        self.id = id
+        self.priority = priority
+        self.client_id = client_id
+        self.params = params
+        self.payload = payload
+        self.webhook_url = webhook_url
+        self.status = status
+        self.result = result
+        self.error = error
+        self.created_at = created_at if created_at is not None else time.time()
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.client_label = client_label
+        self.attempts = attempts
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Public view of the job, without the uploaded image"""
+        data = {
+            "id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "client_id": self.client_label,
+            "attempts": self.attempts,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == DONE:
+            data["result"] = self.result
+        elif self.status == FAILED:
+            data["error"] = self.error
+        return data
+
+
+def check_priority(priority: str) -> str:
+    """Validate a priority lane name"""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{priority}', expected one of {', '.join(PRIORITIES)}")
+    return priority
+
+
+def check_webhook_url(url: str) -> str:
+    """
+    Validate a webhook URL before the server POSTs to it
+
+    Hosts in WEBHOOK_ALLOWED_HOSTS are always accepted. Any other host must
+    resolve to public addresses only, so webhooks cannot reach loopback,
+    private or link-local services such as cloud metadata endpoints.
+
+    Raises:
+        ValueError: If the URL is not http(s) or its host is not allowed
+    """
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("webhook_url must be an http(s) URL")
+    host = parsed.hostname.lower()
+    if host in WEBHOOK_ALLOWED_HOSTS:
+        return url
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parsed.port or 0, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError, ValueError):
+        raise ValueError(f"webhook_url host '{host}' does not resolve")
+    for address in addresses:
+        # Scope ids such as fe80::1%eth0 are not part of the address
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"webhook_url host '{host}' resolves to a non-public address")
+    return url
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Refuse redirects, they could point a checked webhook at a private address"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class MemoryJobQueue:
+    """
+    In-process job queue with priority lanes
+
+    Jobs are lost on restart and only workers of the same process can drain
+    the queue; use SQLiteJobQueue to share it between processes.
+    """
+
+    # Running jobs die with their worker, there is no lease to expire
+    lease_seconds = None
+
+    def __init__(self, max_queued_per_client: Optional[int] = 100, ttl_seconds: Optional[float] = 3600.0):
+        """
+        Args:
+            max_queued_per_client: Queued jobs a client may have before submit fails (None disables)
+            ttl_seconds: Time finished jobs are kept for polling (None keeps them forever)
+        """
+        self.max_queued_per_client = max_queued_per_client
+        self.ttl_seconds = ttl_seconds
+        self._jobs = {}
+        self._lanes = {priority: OrderedDict() for priority in PRIORITIES}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        payload: bytes,
+        params: Dict[str, Any],
+        priority: str = "normal",
+        client_id: str = "anonymous",
+        webhook_url: Optional[str] = None,
+        client_label: Optional[str] = None
+    ) -> Job:
+        """
+        Queue a job
+
+        Args:
+            client_id: Key of the per-client caps, must not be chosen by the client
+            client_label: Client name given by the caller, only reported back
+
+        Raises:
+            QueueFullError: If the client already has max_queued_per_client jobs waiting
+        """
+        check_priority(priority)
+        with self._lock:
+            self._expire()
+            if self.max_queued_per_client is not None:
+                queued = sum(
+                    1 for lane in self._lanes.values() for job in lane.values() if job.client_id == client_id
+                )
+                if queued >= self.max_queued_per_client:
+                    raise QueueFullError(f"Client {client_id} already has {queued} queued jobs")
+            job = Job(
+                uuid.uuid4().hex, priority, client_id, params, payload, webhook_url, client_label=client_label
+            )
+            self._jobs[job.id] = job
+            self._lanes[priority][job.id] = job
+        return job
+
+    def claim(self, max_running_per_client: Optional[int] = None) -> Optional[Job]:
+        """
+        Take the oldest job of the highest priority lane whose client is below its cap
+
+        Args:
+            max_running_per_client: Jobs a client may have running at once (None disables)
+
+        Returns:
+            The job, now marked running, or None if nothing can run
+        """
+        with self._lock:
+            for lane in self._lanes.values():
+                for job in lane.values():
+                    if max_running_per_client is not None and self._running.get(job.client_id, 0) >= max_running_per_client:
+                        continue
+                    del lane[job.id]
+                    job.status = RUNNING
+                    job.started_at = time.time()
+                    job.attempts += 1
+                    self._running[job.client_id] = self._running.get(job.client_id, 0) + 1
+                    return job
+        return None
+
+    def renew(self, job_id: str, attempt: Optional[int] = None) -> bool:
+        """Running jobs never expire in memory, only report whether the job still runs"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job is not None and job.status == RUNNING and attempt in (None, job.attempts)
+
+    def complete(self, job_id: str, result: Dict[str, Any], attempt: Optional[int] = None) -> bool:
+        return self._finish(job_id, attempt, DONE, result=result)
+
+    def fail(self, job_id: str, error: str, attempt: Optional[int] = None) -> bool:
+        return self._finish(job_id, attempt, FAILED, error=error)
+
+    def _finish(
+        self,
+        job_id: str,
+        attempt: Optional[int],
+        status: str,
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None
+    ) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != RUNNING or attempt not in (None, job.attempts):
+                return False
+            job.status, job.result, job.error = status, result, error
+            job.finished_at = time.time()
+            # The upload is not needed anymore
+            job.payload = None
+            self._running[job.client_id] -= 1
+            if not self._running[job.client_id]:
+                del self._running[job.client_id]
+        return True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _expire(self):
+        """Drop finished jobs older than the TTL"""
+        if not self.ttl_seconds:
+            return
+        cutoff = time.time() - self.ttl_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queued jobs per lane and running jobs"""
+        with self._lock:
+            return {
+                "backend": "memory",
+                "queued": {priority: len(lane) for priority, lane in self._lanes.items()},
+                "running": sum(self._running.values()),
+                "jobs": len(self._jobs),
+            }
+
+
+class SQLiteJobQueue:
+    """
+    SQLite-backed job queue that API and worker processes can share
+
+    Claiming runs in an immediate transaction, so several worker processes
+    never take the same job. Workers renew the lease of their running jobs;
+    jobs whose worker died are queued again once it expires, and only the
+    latest attempt of a job can finish it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_queued_per_client: Optional[int] = 100,
+        ttl_seconds: Optional[float] = 3600.0,
+        lease_seconds: float = 600.0
+    ):
+        """
+        Args:
+            path: Path of the SQLite database file
+            max_queued_per_client: Queued jobs a client may have before submit fails (None disables)
+            ttl_seconds: Time finished jobs are kept for polling (None keeps them forever)
+            lease_seconds: Time without renewal after which a running job is assumed lost and queued again
+        """
+        self.path = path
+        self.max_queued_per_client = max_queued_per_client
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, priority TEXT NOT NULL, lane INTEGER NOT NULL, client_id TEXT NOT NULL, "
+            "params TEXT NOT NULL, payload BLOB, webhook_url TEXT, status TEXT NOT NULL, "
+            "result TEXT, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL, client_label TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, lane, created_at)")
+
+    def submit(
+        self,
+        payload: bytes,
+        params: Dict[str, Any],
+        priority: str = "normal",
+        client_id: str = "anonymous",
+        webhook_url: Optional[str] = None,
+        client_label: Optional[str] = None
+    ) -> Job:
+        """
+        Queue a job
+
+        Args:
+            client_id: Key of the per-client caps, must not be chosen by the client
+            client_label: Client name given by the caller, only reported back
+
+        Raises:
+            QueueFullError: If the client already has max_queued_per_client jobs waiting
+        """
+        check_priority(priority)
+        job = Job(uuid.uuid4().hex, priority, client_id, params, payload, webhook_url, client_label=client_label)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.ttl_seconds:
+                    self._conn.execute(
+                        "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                        (time.time() - self.ttl_seconds,)
+                    )
+                if self.max_queued_per_client is not None:
+                    queued = self._conn.execute(
+                        "SELECT COUNT(*) FROM jobs WHERE status = ? AND client_id = ?", (QUEUED, client_id)
+                    ).fetchone()[0]
+                    if queued >= self.max_queued_per_client:
+                        raise QueueFullError(f"Client {client_id} already has {queued} queued jobs")
+                self._conn.execute(
+                    "INSERT INTO jobs (id, priority, lane, client_id, params, payload, webhook_url, status, "
+                    "created_at, client_label) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job.id, priority, PRIORITIES[priority], client_id, json.dumps(params), payload,
+                     webhook_url, QUEUED, job.created_at, client_label)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def claim(self, max_running_per_client: Optional[int] = None) -> Optional[Job]:
+        """
+        Take the oldest job of the highest priority lane whose client is below its cap
+
+        Args:
+            max_running_per_client: Jobs a client may have running at once (None disables)
+
+        Returns:
+            The job, now marked running, or None if nothing can run
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Requeue jobs whose worker stopped renewing them
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ? AND started_at < ?",
+                    (QUEUED, RUNNING, now - self.lease_seconds)
+                )
+                query = f"SELECT {JOB_COLUMNS}, payload FROM jobs WHERE status = ?"
+                args: List[Any] = [QUEUED]
+                if max_running_per_client is not None:
+                    query += (
+                        " AND client_id NOT IN (SELECT client_id FROM jobs WHERE status = ? "
+                        "GROUP BY client_id HAVING COUNT(*) >= ?)"
+                    )
+                    args += [RUNNING, max_running_per_client]
+                query += " ORDER BY lane, created_at LIMIT 1"
+                row = self._conn.execute(query, args).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                        (RUNNING, now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._row_to_job(row[:-1], payload=row[-1])
+        job.status, job.started_at = RUNNING, now
+        job.attempts += 1
+        return job
+
+    def renew(self, job_id: str, attempt: Optional[int] = None) -> bool:
+        """
+        Extend the lease of a running job
+
+        Returns:
+            False if the job is not running anymore, or was requeued and claimed again
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET started_at = ? WHERE id = ? AND status = ? AND (? IS NULL OR attempts = ?)",
+                (time.time(), job_id, RUNNING, attempt, attempt)
+            )
+        return cursor.rowcount > 0
+
+    def complete(self, job_id: str, result: Dict[str, Any], attempt: Optional[int] = None) -> bool:
+        return self._finish(job_id, attempt, DONE, result=json.dumps(result))
+
+    def fail(self, job_id: str, error: str, attempt: Optional[int] = None) -> bool:
+        return self._finish(job_id, attempt, FAILED, error=error)
+
+    def _finish(
+        self,
+        job_id: str,
+        attempt: Optional[int],
+        status: str,
+        result: Optional[str] = None,
+        error: Optional[str] = None
+    ) -> bool:
+        with self._lock:
+            # The upload is not needed anymore
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, payload = NULL "
+                "WHERE id = ? AND status = ? AND (? IS NULL OR attempts = ?)",
+                (status, result, error, time.time(), job_id, RUNNING, attempt, attempt)
+            )
+        return cursor.rowcount > 0
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Return a job without its payload, which polling does not need"""
+        with self._lock:
+            row = self._conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row is not None else None
+
+    def _row_to_job(self, row, payload: Optional[bytes] = None) -> Job:
+        """Build a Job from a row of JOB_COLUMNS"""
+        (job_id, priority, client_id, params, webhook_url, status,
+         result, error, created_at, started_at, finished_at, client_label, attempts) = row
+        return Job(
+            job_id, priority, client_id, json.loads(params), payload, webhook_url, status,
+            json.loads(result) if result is not None else None, error, created_at, started_at, finished_at,
+            client_label, attempts
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queued jobs per lane and running jobs"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, priority, COUNT(*) FROM jobs GROUP BY status, priority").fetchall()
+        queued = {priority: 0 for priority in PRIORITIES}
+        running = jobs = 0
+        for status, priority, count in rows:
+            jobs += count
+            if status == QUEUED:
+                queued[priority] = count
+            elif status == RUNNING:
+                running += count
+        return {"backend": "sqlite", "path": self.path, "queued": queued, "running": running, "jobs": jobs}
+
+
+def deliver_webhook(url: str, data: Dict[str, Any], retries: int = 3, timeout: float = 10.0) -> bool:
+    """
+    POST a job result as JSON, retrying with exponential backoff
+
+    The URL is checked again before each attempt, since its DNS records may
+    have changed since the job was submitted, and redirects are not followed.
+
+    Returns:
+        True if the receiver answered with a 2xx status
+    """
+    body = json.dumps(data).encode("utf-8")
+    opener = urllib.request.build_opener(_NoRedirect)
+    for attempt in range(retries):
+        request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            check_webhook_url(url)
+            with opener.open(request, timeout=timeout) as response:
+                if 200 <= response.status < 300:
+                    return True
+        except ValueError:
+            return False
+        except OSError:
+            pass
+        if attempt + 1 < retries:
+            time.sleep(2 ** attempt)
+    return False
+
+
+class JobWorkerPool:
+    """
+    Asyncio workers draining a job queue
+
+    Queue calls run on the default executor, since SQLite may wait for
+    another process's lock and must not stall the event loop.
+
+    Each worker claims a job, runs the handler on it while renewing the job's
+    lease, stores the result or error, and posts it to the job's webhook if it
+    has one. A worker whose job was meanwhile requeued and claimed by another
+    one drops its result, so the webhook is sent once. Workers wake up
+    when a job is submitted in this process, and poll for jobs submitted by
+    other processes.
+    """
+
+    def __init__(
+        self,
+        queue,
+        handler: Callable[[Job], Awaitable[Dict[str, Any]]],
+        num_workers: int = 2,
+        max_running_per_client: Optional[int] = 2,
+        poll_interval: float = 0.5
+    ):
+        """
+        Args:
+            queue: MemoryJobQueue or SQLiteJobQueue
+            handler: Coroutine function producing the result of a job
+            num_workers: Jobs processed concurrently by this process
+            max_running_per_client: Jobs a client may have running at once across workers
+            poll_interval: Seconds between polls when the queue is empty
+        """
+        self.queue = queue
+        self.handler = handler
+        self.num_workers = num_workers
+        self.max_running_per_client = max_running_per_client
+        self.poll_interval = poll_interval
+
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.jobs_done = 0
+        self.jobs_failed = 0
+
+    def start(self):
+        """Start the workers on the running event loop"""
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.num_workers)]
+
+    async def run_forever(self):
+        """Run the workers until cancelled, for processes that only process jobs"""
+        self.start()
+        await asyncio.gather(*self._tasks)
+
+    def notify(self):
+        """Wake idle workers after a submit"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Cleared before claiming, so a submit made meanwhile is not missed
+            self._wakeup.clear()
+            job = await loop.run_in_executor(None, self.queue.claim, self.max_running_per_client)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heartbeat = loop.create_task(self._renew(job))
+            try:
+                result = await self.handler(job)
+            except Exception as e:
+                finished = await loop.run_in_executor(None, self.queue.fail, job.id, str(e) or repr(e), job.attempts)
+                self.jobs_failed += 1
+            else:
+                finished = await loop.run_in_executor(None, self.queue.complete, job.id, result, job.attempts)
+                self.jobs_done += 1
+            finally:
+                heartbeat.cancel()
+
+            if finished and job.webhook_url:
+                finished = await loop.run_in_executor(None, self.queue.get, job.id)
+                if finished is not None:
+                    # Delivery retries must not hold up the next job
+                    loop.run_in_executor(None, deliver_webhook, job.webhook_url, finished.to_dict())
+
+    async def _renew(self, job: Job):
+        """Renew the lease of a running job three times per lease period"""
+        if not self.queue.lease_seconds:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not await loop.run_in_executor(None, self.queue.renew, job.id, job.attempts):
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.num_workers,
+            "max_running_per_client": self.max_running_per_client,
+            "done": self.jobs_done,
+            "failed": self.jobs_failed,
+            "queue": self.queue.stats(),
+        }
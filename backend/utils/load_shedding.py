@@ -0,0 +1,130 @@
+import math
+import threading
+from typing import Any, Dict, Optional
+
+# Which path produced a caption
+LLM = "llm"
+LLM_TRUNCATED = "llm_truncated"
+FALLBACK = "fallback"
+
+
+class ShedDecision:
+    """How one request's captions should be produced"""
+
+    __slots__ = ("path", "max_new_tokens", "predicted_ms")
+
+    def __init__(self, path: str, max_new_tokens: int, predicted_ms: Optional[float] = None):
+        self.path = path
+        self.max_new_tokens = max_new_tokens
+        self.predicted_ms = predicted_ms
+
+
+class LoadShedder:
+    """
+    Decide per request whether the LLM can answer within its latency budget
+
+    The cost of one decoding step is learned online as an exponentially
+    weighted moving average. A request waits for the batches queued ahead of
+    it plus its own batch, so its predicted latency is
+
+        (batches ahead + 1) * max_new_tokens * seconds per step
+
+    where max_new_tokens is the token limit of the request's caption style.
+    When that exceeds the budget, the request first gets fewer new tokens,
+    and falls back to template captions if even `min_new_tokens` would not fit
+    or the queue is deeper than `max_queue_depth`.
+    """
+
+    def __init__(
+        self,
+        max_new_tokens: int = 50,
+        min_new_tokens: int = 12,
+        max_batch_size: int = 4,
+        max_queue_depth: Optional[int] = None,
+        default_budget_ms: Optional[float] = None,
+        smoothing: float = 0.2
+    ):
+        """
+        Args:
+            max_new_tokens: Token limit of a full LLM caption
+            min_new_tokens: Shortest truncated caption worth generating
+            max_batch_size: Requests per generation batch, to turn queue depth into batches
+            max_queue_depth: Queue depth at which every request falls back (None disables)
+            default_budget_ms: Budget for requests that do not set one (None disables)
+            smoothing: EWMA weight of the newest observation
+        """
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min_new_tokens
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_queue_depth = max_queue_depth
+        self.default_budget_ms = default_budget_ms
+        self.smoothing = smoothing
+
+        self._seconds_per_step = None
+        self._lock = threading.Lock()
+        self.decisions = {LLM: 0, LLM_TRUNCATED: 0, FALLBACK: 0}
+
+    def observe(self, steps: int, seconds: float):
+        """Record the duration of a generation call that ran `steps` decoding steps"""
+        if steps <= 0:
+            return
+        sample = seconds / steps
+        with self._lock:
+            if self._seconds_per_step is None:
+                self._seconds_per_step = sample
+            else:
+                self._seconds_per_step += self.smoothing * (sample - self._seconds_per_step)
+
+    def decide(
+        self,
+        queue_depth: int,
+        budget_ms: Optional[float] = None,
+        max_new_tokens: Optional[int] = None
+    ) -> ShedDecision:
+        """
+        Choose the caption path for a request
+
+        Args:
+            queue_depth: Number of requests queued or running ahead of this one
+            budget_ms: Latency budget of the request, defaults to default_budget_ms
+            max_new_tokens: Token limit of the request's style, defaults to max_new_tokens
+
+        Returns:
+            ShedDecision with the path and token limit to use
+        """
+        budget_ms = budget_ms if budget_ms is not None else self.default_budget_ms
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        # Short styles are worth generating even below the usual minimum
+        min_new_tokens = min(self.min_new_tokens, max_new_tokens)
+
+        if self.max_queue_depth is not None and queue_depth >= self.max_queue_depth:
+            return self._record(ShedDecision(FALLBACK, 0))
+
+        if not budget_ms or self._seconds_per_step is None:
+            # No budget, or nothing learned yet: always use the LLM
+            return self._record(ShedDecision(LLM, max_new_tokens))
+
+        batches = math.ceil(queue_depth / self.max_batch_size) + 1
+        ms_per_token = batches * self._seconds_per_step * 1000.0
+        predicted_ms = max_new_tokens * ms_per_token
+        if predicted_ms <= budget_ms:
+            return self._record(ShedDecision(LLM, max_new_tokens, predicted_ms))
+
+        affordable = int(budget_ms / ms_per_token)
+        if affordable >= min_new_tokens:
+            return self._record(ShedDecision(LLM_TRUNCATED, affordable, affordable * ms_per_token))
+        return self._record(ShedDecision(FALLBACK, 0, predicted_ms))
+
+    def _record(self, decision: ShedDecision) -> ShedDecision:
+        with self._lock:
+            self.decisions[decision.path] += 1
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the learned step cost and decision counters"""
+        return {
+            "ms_per_step": self._seconds_per_step * 1000.0 if self._seconds_per_step is not None else None,
+            "default_budget_ms": self.default_budget_ms,
+            "max_queue_depth": self.max_queue_depth,
+            "decisions": dict(self.decisions),
+        }
@@ -30,7 +30,7 @@ function App() {
     }
   };
   
-  const handleImageUpload = async (imageFile, style = selectedStyle) => {
+  const handleImageUpload = async (imageFile, style = selectedStyle, fresh = false) => {
     setLoading(true);
     setError(null);
     
@@ -41,6 +41,7 @@ function App() {
       formData.append('style', style);
       formData.append('num_captions', 3);
       formData.append('num_hashtags', 10);
+      formData.append('fresh', fresh);
       
       // Make API request
       const response = await fetch('http://localhost:8000/analyze', {
@@ -65,7 +66,8 @@ function App() {
   
   const handleRetry = () => {
     if (image) {
-      handleImageUpload(image);
+      // Ask for new captions instead of the cached ones
+      handleImageUpload(image, selectedStyle, true);
     }
   };
   